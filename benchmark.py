@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+# Copyright (C) 2016 Russell Haley
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""benchmark.py: Performance measurements for fat.py
+
+Usage:
+  benchmark.py parse [--lines=<n>] [--repeat=<n>]
+  benchmark.py time_series [--lines=<n>] [--repeat=<n>] [--avg=<days>]
+  benchmark.py startup [--repeat=<n>]
+  benchmark.py weigh [--samples=<n>] [--navg=<n>] [--repeat=<n>]
+  benchmark.py redefine [--lines=<n>] [--repeat=<n>]
+  benchmark.py suite [options] [--repeat=<n>] [--avg=<days>]
+
+Commands:
+  parse         Compare fatscript parse throughput of fat.parseLine against
+                the shlex + argparse parser it replaced.
+  time_series   Compare fat.timeSeries against calling filteredRange once per
+                day, and check that both give the same rows.
+  startup       Time each fat.py command from a cold start on a small log,
+                and check with python -X importtime that query doesn't import
+                the dependencies only needed for loading fatscript.
+  weigh         Compare weigh.py's settle detector, sample by sample from a
+                recording and from memory, against its NumPy batch version
+                on a long synthetic recording, and check that all three
+                settle on the same sample and weight.
+  redefine      Compare redefining a base ingredient with FoodDB.redefine,
+                through a view of part of the log, against reloading the
+                edited corpus, and check that both the FoodDB and the view
+                match the reload.
+  suite         Time loading and every report command on a synthetic corpus,
+                with throughput and peak memory, optionally saving the results
+                or comparing them with saved ones.
+
+Options:
+  --lines=<n>    Number of synthetic fatscript lines to load.  [default: 100000]
+  --repeat=<n>   Take the best of this many runs.  [default: 3]
+  --avg=<days>   Moving average window for time_series.  [default: 7]
+  --samples=<n>  Number of samples in the synthetic recording.
+                 [default: 1000000]
+  --navg=<n>     Samples in each of the settle detector's moving averages.
+                 [default: 100]
+
+Suite options:
+  --ingredients=<n>  Number of base ingredients.  [default: 2000]
+  --recipes=<n>      Number of combine recipes.  [default: 500]
+  --depth=<n>        How deep recipes nest.  [default: 4]
+  --years=<n>        Years of meals, up to now.  [default: 10]
+  --density=<n>      Meals per day.  [default: 6]
+  --files=<n>        Number of files to spread the meals over.  [default: 4]
+  --save=<json>      Save the results to this file.
+  --compare=<json>   Compare the results with those saved in this file.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from datetime import timedelta
+from docopt import docopt
+
+import fat
+import weigh
+
+
+class ThrowingArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise ValueError(message)
+
+legacyParsers = {}
+legacyParsers["ingredient"] = ThrowingArgumentParser()
+legacyParsers["ingredient"].add_argument("name")
+legacyParsers["ingredient"].add_argument("--unit", "-u", required=True)
+for _flag, _short in [("amt", "a"), ("kcal", "C"), ("carbs", "c"),
+                      ("fat", "f"), ("protein", "p")]:
+    legacyParsers["ingredient"].add_argument("--" + _flag, "-" + _short,
+                                             type=float, required=True)
+legacyParsers["combine"] = ThrowingArgumentParser()
+legacyParsers["combine"].add_argument("name")
+legacyParsers["combine"].add_argument("ingredList", nargs="+")
+legacyParsers["combine"].add_argument("--amt", "-a", type=float, default=1.0)
+legacyParsers["combine"].add_argument("--unit", "-u", default="serving")
+legacyParsers["eat"] = ThrowingArgumentParser()
+legacyParsers["eat"].add_argument("time", type=float)
+legacyParsers["eat"].add_argument("item")
+legacyParsers["eat"].add_argument("--amt", "-a", type=float, default=1.0)
+
+def legacyParseLine(line):
+    """The original FoodDB._parseLine tokenizing and argument parsing."""
+    args = shlex.split(line, comments=True)
+    if len(args) == 0:
+        return None
+    return (args[0], legacyParsers[args[0]].parse_args(args[1:]))
+
+def syntheticLines(n, seed=0):
+    """A fatscript corpus of n lines, mostly eat lines in the usual forms."""
+    rng = random.Random(seed)
+    lines = []
+    foods = []
+    t = 1300000000
+    for i in range(n):
+        roll = rng.random()
+        if roll < 0.05 or len(foods) < 2:
+            name = "food_{}".format(i)
+            lines.append("ingredient {} --unit=g --amt=100 --kcal={} --carbs={} "
+                         "--fat={} --protein={}".format(name,
+                         rng.randint(10, 900), rng.randint(0, 90),
+                         rng.randint(0, 90), rng.randint(0, 40)))
+            foods.append(name)
+        elif roll < 0.07:
+            name = "recipe {}".format(i)
+            parts = ["'{}'".format(f) for f in rng.sample(foods, 2)]
+            amt = rng.randint(1, 500)
+            lines.append('combine "{}" {} {} {} 1.5 --amt={} # weighted mix'.format(
+                         name, parts[0], amt, parts[1], amt + 1.5))
+            foods.append(name)
+        elif roll < 0.08:
+            lines.append("# just a comment")
+        else:
+            t += rng.randint(600, 3000)
+            food = rng.choice(foods)
+            if " " in food:
+                food = "'{}'".format(food)
+            amt = "" if rng.random() < 0.5 else " --amt={}".format(
+                    rng.randint(1, 300))
+            lines.append("eat {} {}{}".format(t, food, amt))
+    return lines
+
+def loadLines(lines):
+    """A FoodDB loaded from a list of fatscript lines."""
+    with tempfile.NamedTemporaryFile("w", suffix=".fat", delete=False) as file:
+        file.write("\n".join(lines) + "\n")
+    try:
+        return fat.FoodDB([file.name])
+    finally:
+        os.unlink(file.name)
+
+def syntheticDB(nlines):
+    """A FoodDB loaded from syntheticLines(nlines)."""
+    return loadLines(syntheticLines(nlines))
+
+def legacyTimeSeries(db, avg):
+    """The original doTimeSeries loop, calling filteredRange once per day.
+
+    Days with nothing eaten, on which the original raised ZeroDivisionError,
+    are given NaN percentages like fat.timeSeries.
+    """
+    times = []
+    rows = []
+    cursor = fat.zeroHourDatetime(db.begin)
+    step = timedelta(days=1)
+    avg_td = timedelta(days=avg)
+    while cursor < db.end:
+        window = db.filteredRange(cursor + step - avg_td, cursor + step)
+        try:
+            rows.append(tuple(window.meanDailyStats()))
+        except ZeroDivisionError:
+            rows.append((0.0,) + (float("nan"),) * 3 + (0.0,) * 3)
+        times.append(cursor.timestamp())
+        cursor += step
+    return times, np.array(rows).reshape(-1, 7)
+
+def bestOf(repeat, fun, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchParse(nlines, repeat):
+    lines = syntheticLines(nlines)
+    for line in lines:
+        new = fat.parseLine(line)
+        old = legacyParseLine(line)
+        if (new is None) != (old is None) or (new is not None and
+                new[1]._asdict() != vars(old[1])):
+            raise AssertionError("Parsers disagree on {!r}".format(line))
+    def run(parse):
+        for line in lines:
+            parse(line)
+    legacy = bestOf(repeat, run, legacyParseLine)
+    current = bestOf(repeat, run, fat.parseLine)
+    print("{:10} {:>10} {:>14}".format("parser", "seconds", "lines/s"))
+    print("{:10} {:10.3f} {:14.0f}".format("legacy", legacy, nlines / legacy))
+    print("{:10} {:10.3f} {:14.0f}".format("fatscript", current, nlines / current))
+    print("speedup {:.1f}x".format(legacy / current))
+
+def benchTimeSeries(nlines, repeat, avg):
+    db = syntheticDB(nlines)
+    legacyTimes, legacyRows = legacyTimeSeries(db, avg)
+    times, rows = fat.timeSeries(db, avg)
+    if times != legacyTimes or not np.allclose(rows, legacyRows, rtol=1e-9,
+                                               equal_nan=True):
+        raise AssertionError("time series differ from the legacy implementation")
+    legacy = bestOf(repeat, legacyTimeSeries, db, avg)
+    current = bestOf(repeat, fat.timeSeries, db, avg)
+    print("{} days, {} meals".format(len(times), len(db.eaten)))
+    print("{:10} {:>10} {:>14}".format("engine", "seconds", "days/s"))
+    print("{:10} {:10.3f} {:14.0f}".format("legacy", legacy, len(times) / legacy))
+    print("{:10} {:10.3f} {:14.0f}".format("prefix", current, len(times) / current))
+    print("speedup {:.1f}x".format(legacy / current))
+
+def syntheticRecording(nsamples, navg, seed=0):
+    """Balance board samples that only settle at the end.
+
+    Someone stands on the board, but keeps pressing down an extra 20 kg in
+    bursts of just under navg samples, so the head and tail averages of the
+    settle detector never agree.  The last 3 * navg samples are steady.
+    """
+    rng = np.random.default_rng(seed)
+    index = np.arange(nsamples)
+    burst = navg - 3 + navg % 2
+    total = np.where((index // burst) % 2 == 0, 8000, 8000 + 20 * navg)
+    total[nsamples - 3 * navg:] = 8000
+    # Split over the sensors, each with a little noise
+    sensors = (total[:, None] * np.array([0.2, 0.3, 0.24, 0.26])).astype(int)
+    sensors += rng.integers(-3, 4, size=sensors.shape)
+    return sensors.astype("<i4")
+
+def benchWeigh(nsamples, navg, repeat):
+    samples = syntheticRecording(nsamples, navg)
+    tuples = [tuple(s) for s in samples.tolist()]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "recording")
+        with open(path, "wb") as file:
+            file.write(weigh.RECORDING_MAGIC)
+            file.write(samples.tobytes())
+        read = [0]
+        def counted():
+            for sample in weigh.replay_gen(path):
+                read[0] += 1
+                yield sample
+        streamed = weigh.get_weight(counted(), navg)
+        batch = weigh.find_settled(weigh.read_recording(path), navg)
+        if batch != (read[0], streamed) or \
+                weigh.get_weight(iter(tuples), navg) != streamed:
+            raise AssertionError("settle detectors disagree: {} {} {}".format(
+                    read[0], streamed, batch))
+        replay = bestOf(repeat, lambda: weigh.get_weight(
+                weigh.replay_gen(path), navg))
+        memory = bestOf(repeat, lambda: weigh.get_weight(iter(tuples), navg))
+        numpy = bestOf(repeat, lambda: weigh.find_settled(
+                weigh.read_recording(path), navg))
+    print("settled after {} samples at {:.2f} kg".format(*batch))
+    print("{:10} {:>10} {:>14}".format("detector", "seconds", "samples/s"))
+    for name, seconds in [("replay", replay), ("memory", memory),
+                          ("batch", numpy)]:
+        print("{:10} {:10.3f} {:14.0f}".format(name, seconds,
+                                               batch[0] / seconds))
+    print("speedup {:.1f}x".format(memory / numpy))
+
+def sameTables(db, expected):
+    """Whether two FoodDBs have the same foods and meals, up to rounding."""
+    return (db.ingredients.names == expected.ingredients.names and
+            np.allclose(db.ingredients.nutrients, expected.ingredients.nutrients,
+                        rtol=1e-12) and
+            np.array_equal(db.eaten.time, expected.eaten.time) and
+            np.allclose(db.eaten.nutrients, expected.eaten.nutrients,
+                        rtol=1e-12))
+
+def benchRedefine(nlines, repeat):
+    lines = syntheticLines(nlines)
+    # The first ingredient goes into the most recipes
+    index = next(i for i, line in enumerate(lines)
+                 if line.startswith("ingredient "))
+    name = lines[index].split()[1]
+    edited = "ingredient {} --unit=g --amt=100 --kcal=123 --carbs=4 " \
+             "--fat=5 --protein=6".format(name)
+    db = syntheticDB(nlines)
+    middle = db.begin + (db.end - db.begin) / 2
+    view = db.filteredRange(middle, middle + timedelta(days=30))
+    view.redefine(edited)
+    expected = loadLines(lines[:index] + [edited] + lines[index + 1:])
+    if not sameTables(db, expected) or not sameTables(view,
+            expected.filteredRange(view.begin, view.end)):
+        raise AssertionError("redefining through a view differs from "
+                             "reloading the edited corpus")
+    food = db.ingredients.ids[name]
+    affected = db.ingredients.recipesUsing([food])
+    meals = np.isin(db.eaten.food, np.append(affected, food)).sum()
+    original = lines[index]
+    def toggle():
+        db.redefine(original)
+        db.redefine(edited)
+    reload = bestOf(repeat, loadLines, lines)
+    redefine = bestOf(repeat, toggle) / 2
+    print("{} recipes and {} meals affected".format(len(affected), meals))
+    print("{:10} {:>10}".format("update", "seconds"))
+    print("{:10} {:10.3f}".format("reload", reload))
+    print("{:10} {:10.3f}".format("redefine", redefine))
+    print("speedup {:.0f}x".format(reload / redefine))
+
+# fat.py arguments for each command timed by benchStartup, before the file
+startupCommands = [
+    ("summary", ["summary"]),
+    ("summary -b", ["-b", "two weeks ago", "summary"]),
+    ("today", ["today"]),
+    ("blame", ["blame"]),
+    ("dump", ["dump"]),
+    ("time_series", ["--avg=7", "time_series"]),
+    ("report -b -e", ["-b", "two weeks ago", "-e", "tomorrow", "report",
+                      "summary", "blame", "time_series"]),
+]
+
+# Modules that query must not import, or it is no longer a thin client
+heavyModules = ["numpy", "parsedatetime", "concurrent.futures", "zipfile"]
+
+def runFat(argv):
+    """Run fat.py in a fresh interpreter, returning the wall clock time."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, fat.__file__] + argv, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def importTimes(argv):
+    """Cumulative import time in seconds of each module fat.py argv imports."""
+    result = subprocess.run([sys.executable, "-X", "importtime", fat.__file__]
+                            + argv, check=True, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        if name.strip() not in times:
+            times[name.strip()] = (int(cumulative) * 1e-6,
+                                   not name[1:].startswith(" "))
+    return times
+
+def startupRow(label, argv, repeat):
+    cold = min(runFat(argv) for _ in range(repeat))
+    times = importTimes(argv)
+    imports = sum(t for t, topLevel in times.values() if topLevel)
+    # fat.py imports numpy lazily, so its submodules show up as top level
+    numpy = sum(t for name, (t, topLevel) in times.items()
+                if topLevel and name.split(".")[0] == "numpy")
+    print("{:14} {:10.1f} {:10.1f} {:10.1f}".format(label, cold * 1000,
+          imports * 1000, numpy * 1000))
+    return times
+
+def benchStartup(repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, "log.fat")
+        with open(fn, "w") as file:
+            lines = syntheticLines(1000)
+            file.write("\n".join(lines) + "\n")
+            file.write("eat {} food_0\n".format(int(time.time())))
+        print("{:14} {:>10} {:>10} {:>10}".format("command", "cold ms",
+                                                   "import ms", "numpy ms"))
+        for label, argv in startupCommands:
+            startupRow(label, ["--no-cache"] + argv + [fn], repeat)
+        path = os.path.join(tmp, "socket")
+        server = subprocess.Popen([sys.executable, fat.__file__, "serve", path,
+                                   fn])
+        try:
+            while True:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    try:
+                        probe.connect(path)
+                        break
+                    except OSError:
+                        if server.poll() is not None:
+                            raise AssertionError("fat.py serve exited")
+                        time.sleep(0.05)
+            times = startupRow("query", ["query", path, "summary"], repeat)
+        finally:
+            server.terminate()
+            server.wait()
+    heavy = [m for m in heavyModules
+             if any(name == m or name.startswith(m + ".") for name in times)]
+    if heavy:
+        raise AssertionError("query imports {}".format(", ".join(heavy)))
+
+def syntheticCorpus(directory, ingredients, recipes, depth, years, density,
+                    files, seed=0):
+    """Write a realistic fatscript corpus to a directory.
+
+    Parameters
+    ==========
+    directory : str
+        where to write the files
+    ingredients : int
+        number of base ingredients
+    recipes : int
+        number of combine recipes, spread over depth levels of nesting; each
+        recipe uses at least one recipe from the level below it
+    depth : int
+        how deep recipes nest
+    years : float
+        the meals span this many years, ending a minute ago
+    density : float
+        mean number of meals per day
+    files : int
+        number of files to spread the meals over, as if they were logged by
+        different devices; each file's meals are in time order
+
+    Returns
+    =======
+    The file names, starting with the library of ingredients and recipes,
+    and the number of meals.
+    """
+    rng = random.Random(seed)
+    levels = [["food_{}".format(i) for i in range(ingredients)]]
+    library = os.path.join(directory, "library.fat")
+    with open(library, "w") as file:
+        for name in levels[0]:
+            file.write("ingredient {} --unit=g --amt=100 --kcal={} --carbs={} "
+                       "--fat={} --protein={}\n".format(name,
+                       rng.randint(10, 900), rng.randint(0, 90),
+                       rng.randint(0, 90), rng.randint(0, 40)))
+        for i in range(recipes):
+            level = min(depth, 1 + i * depth // max(1, recipes))
+            while len(levels) <= level:
+                levels.append([])
+            parts = [rng.choice(levels[level - 1])] + [rng.choice(
+                     levels[rng.randrange(level)]) for _ in range(rng.randint(1, 5))]
+            name = "recipe {}".format(i)
+            file.write('combine "{}" {} --amt={} # level {}\n'.format(name,
+                       " ".join("'{}' {}".format(p, rng.randint(1, 300))
+                                for p in parts),
+                       rng.randint(1, 10), level))
+            levels[level].append(name)
+    foods = [f for level in levels for f in level]
+    logs = [os.path.join(directory, "meals{}.fat".format(i))
+            for i in range(files)]
+    end = time.time() - 60
+    t = end - years * 365.25 * 86400
+    meals = 0
+    outs = [open(fn, "w") for fn in logs]
+    try:
+        while t < end:
+            food = rng.choice(foods)
+            amt = "" if rng.random() < 0.3 else " --amt={}".format(
+                    rng.randint(1, 300))
+            rng.choice(outs).write("eat {} '{}'{}\n".format(int(t), food, amt))
+            meals += 1
+            t += rng.expovariate(density / 86400)
+        outs[-1].write("eat {} '{}'\n".format(int(end), foods[0]))
+        meals += 1
+    finally:
+        for out in outs:
+            out.close()
+    return [library] + logs, meals
+
+def measure(fun, repeat):
+    """Best wall clock time of fun over repeat runs, and its peak memory.
+
+    Peak memory is measured with tracemalloc in a separate run, since tracing
+    slows everything down.
+    """
+    seconds = bestOf(repeat, fun)
+    tracemalloc.start()
+    try:
+        fun()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+def benchSuite(args):
+    repeat = int(args['--repeat'])
+    avg = args['--avg']
+    params = {name.lstrip("-"): args[name] for name in ("--ingredients",
+              "--recipes", "--depth", "--years", "--density", "--files")}
+    with tempfile.TemporaryDirectory() as tmp:
+        filenames, meals = syntheticCorpus(tmp, int(args['--ingredients']),
+                int(args['--recipes']), int(args['--depth']),
+                float(args['--years']), float(args['--density']),
+                int(args['--files']))
+        # Reports go through the compiled cache like a normal run
+        fat.FoodDB(filenames, cache=True)
+        cases = [
+            ("load", lambda: fat.FoodDB(filenames)),
+            ("load cached", lambda: fat.FoodDB(filenames, cache=True)),
+        ]
+        for name, argv in [
+                ("summary", ["summary"]),
+                ("summary --stream", ["--stream", "summary"]),
+                ("today", ["today"]),
+                ("blame", ["blame"]),
+                ("dump", ["dump"]),
+                ("time_series", ["--avg={}".format(avg), "time_series"])]:
+            cases.append((name, lambda argv=argv: runMain(argv + filenames)))
+        results = {}
+        for name, fun in cases:
+            seconds, peak = measure(fun, repeat)
+            results[name] = {"seconds": seconds, "meals_per_s": meals / seconds,
+                             "peak_bytes": peak}
+    params = dict(params, avg=avg, meals=meals)
+    previous = {}
+    if args['--compare']:
+        with open(args['--compare']) as file:
+            saved = json.load(file)
+        previous = saved["results"]
+        if saved["params"] != params:
+            print("Comparing with a different corpus: {}".format(
+                  saved["params"]))
+    print("{} meals in {} files".format(meals, len(filenames)))
+    print("{:18} {:>10} {:>12} {:>10} {:>8}".format("case", "seconds",
+          "meals/s", "peak MB", "change"))
+    for name, result in results.items():
+        change = ""
+        if name in previous:
+            change = "{:+.0%}".format(result["seconds"] /
+                                      previous[name]["seconds"] - 1)
+        print("{:18} {:10.3f} {:12.0f} {:10.1f} {:>8}".format(name,
+              result["seconds"], result["meals_per_s"],
+              result["peak_bytes"] / 2**20, change))
+    if args['--save']:
+        with open(args['--save'], "w") as file:
+            json.dump({"params": params,
+                       "python": sys.version.split()[0],
+                       "numpy": np.__version__,
+                       "results": results}, file, indent=2)
+
+def runMain(argv):
+    """Run fat.main with argv, throwing away what it prints."""
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            fat.main(argv)
+
+def main(injectArgs=None):
+    args = docopt(__doc__, argv=injectArgs)
+    if args['parse']:
+        benchParse(int(args['--lines']), int(args['--repeat']))
+    elif args['time_series']:
+        benchTimeSeries(int(args['--lines']), int(args['--repeat']),
+                        float(args['--avg']))
+    elif args['startup']:
+        benchStartup(int(args['--repeat']))
+    elif args['weigh']:
+        benchWeigh(int(args['--samples']), int(args['--navg']),
+                   int(args['--repeat']))
+    elif args['redefine']:
+        benchRedefine(int(args['--lines']), int(args['--repeat']))
+    elif args['suite']:
+        benchSuite(args)
+
+if __name__ == "__main__":
+    main()
@@ -17,8 +17,17 @@
 """fat.py: Food Accumulator Tool
 
 Usage:
-  fat.py [-b <date>] [-e <date>] (summary | today | blame | dump) <file>...
-  fat.py [-b <date>] [-e <date>] [--avg=<days>] time_series <file>...
+  fat.py [options] [--stream] summary <file>...
+  fat.py [options] today <file>...
+  fat.py [options] [--format=<fmt>] dump <file>...
+  fat.py [options] [--window=<days>] blame <file>...
+  fat.py [options] [--stream] [--avg=<days>] [--binary=<out>] time_series <file>...
+  fat.py [options] [--avg=<days>] [--smooth=<days>] weight (--weights=<log>)... <file>...
+  fat.py [options] [--avg=<days>] batch (summary | time_series) <library> <file>...
+  fat.py [options] [--avg=<days>] [--window=<days>] [--format=<fmt>] report (summary | today | blame | dump | time_series)... <file>...
+  fat.py [options] import <database> <file>...
+  fat.py [options] serve <socket> <file>...
+  fat.py [options] [--avg=<days>] [--window=<days>] [--format=<fmt>] query <socket> (summary | today | blame | dump | time_series)
 
 Commands:
   summary       Show the average daily Calorie intake and macro ratios for the
@@ -29,8 +38,19 @@ Commands:
                 Calories and macronutrients.
   time_series   Print the daily Calorie intake and macro ratios for every day
                 the interval, using a gnuplot-friendly space separated format.
+  weight        Print the daily Calorie intake next to the weight logged by
+                weigh.py, with the energy balance and expenditure they imply.
   dump          Print the ingredient table and meal log as they are represented
                 internally.
+  batch         Make a summary or time_series report for each of many logs, which
+                eat the foods defined in one shared library file.
+  report        Make several of the reports above from one load of the files,
+                concurrently, printing each as a section.
+  import        Compile the files into a SQLite database, which can be given
+                as the only <file> to the other commands instead.
+  serve         Keep the files loaded and answer queries on a Unix socket,
+                reloading the files when they change.
+  query         Ask the server on a Unix socket for one of the reports above.
 
 Options:
   -b <date> --begin-interval=<date>  Only consider food eaten after this date.  
@@ -40,22 +60,104 @@ Options:
                                      Natural language dates, such as 
                                      "two weeks ago", are accepted.
   --avg=<days>                       Moving average over some number of days in 
-                                     time_series mode.  [default: 1]
+                                     time_series and weight modes.
+                                     [default: 1]
+  --binary=<out>                     Write the time_series columns to the file
+                                     out as little-endian float64 instead of
+                                     printing them: a NumPy .npy file if out
+                                     ends in .npy, otherwise raw records of
+                                     eight values for gnuplot.
+  --weights=<log>                    A weight log written by weigh.py, for
+                                     weight mode.  May be given more than
+                                     once.
+  --smooth=<days>                    Average weight over some number of days
+                                     in weight mode.  [default: 7]
+  --format=<fmt>                     Format of dump: text, tsv for tab
+                                     separated tables, or jsonl for a JSON
+                                     object per line.  [default: text]
+  --window=<days>                    Blame each window of some number of days
+                                     separately, printing the top five
+                                     culprits for each.
+  --no-cache                         Parse the files without reading or
+                                     writing the compiled cache.
+  --clear-cache                      Delete the compiled cache for these files
+                                     before loading them.
+  --jobs=<n>                         Number of processes to parse multiple
+                                     files, in batch mode to load and report
+                                     on the logs, and in report mode to make
+                                     the reports with.  [default: 1]
+  --stream                           Read the meals from the files as the
+                                     report goes, in memory that doesn't
+                                     grow with the length of the log,
+                                     instead of loading them.  The
+                                     compiled cache isn't used.
+  --profile                          Print the time spent in each phase of
+                                     loading and reporting, and counts of
+                                     lines parsed, meals and so on, to
+                                     stderr.
+  --profile-json                     Like --profile, but as JSON.
 """
 
 import sys
-import argparse
-import shlex
-import parsedatetime
-import numbers
-import numpy as np
-from collections import namedtuple, defaultdict
+import os
+import io
+import time
+import contextlib
+import importlib.util
+import socket
+import socketserver
+import threading
+import heapq
+import itertools
+import re
+import json
+from collections import namedtuple
 from datetime import datetime, timedelta
 from docopt import docopt
-from bisect import bisect
-from pprint import pformat
 
 
+def lazyImport(name):
+    """Import a module, but only run it when one of its attributes is used.
+
+    Most commands only need a few of fat.py's dependencies, and query needs
+    none of the heavy ones, so they are imported lazily to keep startup fast.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    _lazyModules.append(module)
+    return module
+
+_lazyModules = []
+
+def loadLazyModules():
+    """Finish importing every module imported with lazyImport.
+
+    Before Python 3.12, the first use of a lazily imported module isn't
+    thread-safe: another thread can see it half-loaded.  So this is called
+    before starting threads that report on a FoodDB.
+    """
+    for module in _lazyModules:
+        getattr(module, "__name__")
+
+copy = lazyImport("copy")
+traceback = lazyImport("traceback")
+concurrent = lazyImport("concurrent")
+concurrent.futures = lazyImport("concurrent.futures")
+multiprocessing = lazyImport("multiprocessing")
+hashlib = lazyImport("hashlib")
+tempfile = lazyImport("tempfile")
+zipfile = lazyImport("zipfile")
+numbers = lazyImport("numbers")
+np = lazyImport("numpy")
+sqlite3 = lazyImport("sqlite3")
+parsedatetime = lazyImport("parsedatetime")
+
 # Food Accumulator Tool Script:
 #
 # ingredient butter --unit=cup --amt=1 --kcal=1628 --carbs=0.1 --fat=184 --protein=1.9
@@ -65,31 +167,317 @@ from pprint import pformat
 # combine "cheesy mac" butter 0.25 milk_2% 0.2 boxmac 1.5 cheese_cheddar_mild 60 #optional --amt=1 --unit=serving (defaults)
 # eat 1463977331 "cheesy mac" #optional --amt=2 (default: 1)
 
-class ThrowingArgumentParser(argparse.ArgumentParser):
-    def error(self, message):
-        raise ValueError(message)
+class FatscriptError(ValueError):
+    """A fatscript file could not be loaded."""
+
+
+class FatscriptCommand:
+    """Grammar of one fatscript command.
+
+    Mirrors the argparse conventions the commands have always been parsed
+    with: long options may be abbreviated to an unambiguous prefix, take their
+    value as "--opt=x" or "--opt x", short aliases take "-ox", "-o=x" or
+    "-o x", options may be interleaved with positionals, and "--" ends option
+    processing.  As with argparse's nargs="+", the trailing positionals of a
+    command that takes them stop at the next option.
+    """
+
+    _REQUIRED = object()
+    _negativeNumber = re.compile(r"^-\d+$|^-\d*\.\d+$")
+
+    def __init__(self, name, positionals, options, varargs=None):
+        """
+        Parameters
+        ==========
+        name : str
+            command word
+        positionals : list of (dest, type)
+            required positional arguments, in order
+        options : list of (dest, long flag, short flag, type, default)
+            options; a default of FatscriptCommand._REQUIRED makes the option
+            mandatory
+        varargs : str or None
+            dest collecting one or more trailing positionals
+        """
+        self.name = name
+        self.positionals = positionals
+        self.options = options
+        self.varargs = varargs
+        fields = [p for p, _ in positionals]
+        if varargs is not None:
+            fields.append(varargs)
+        fields.extend(o[0] for o in options)
+        self.Args = namedtuple(name.capitalize() + "Args", fields)
+        self._longFlags = {o[1]: o for o in options}
+        self._shortFlags = {o[2]: o for o in options}
+
+    @staticmethod
+    def _argName(spec):
+        return "/".join(spec[1:3])
+
+    def _convert(self, name, typ, value):
+        if typ is str:
+            return value
+        try:
+            return typ(value)
+        except ValueError:
+            raise ValueError("argument {}: invalid {} value: '{}'".format(
+                name, typ.__name__, value))
+
+    def _lookupLong(self, flag):
+        if flag in self._longFlags:
+            return self._longFlags[flag]
+        matches = [f for f in self._longFlags if f.startswith(flag)]
+        if len(matches) == 1:
+            return self._longFlags[matches[0]]
+        elif len(matches) > 1:
+            raise ValueError("ambiguous option: {} could match {}".format(
+                flag, ", ".join(matches)))
+        return None
+
+    def _isValue(self, token):
+        return not token.startswith("-") or token == "-" or \
+                self._negativeNumber.match(token) is not None
+
+    def _consumePositionals(self, chunk, separator, values, extras, filled):
+        """Give a run of positional tokens to the positionals not yet filled.
+
+        As argparse does, each positional gets its tokens when the option
+        after them is reached, the trailing positionals take the rest of the
+        run they start in, and whatever is left over is unrecognized.
+
+        Returns
+        =======
+        The number of positionals filled, counting the trailing ones as one.
+        """
+        nfixed = len(self.positionals)
+        nslots = nfixed + (self.varargs is not None)
+        owners = []
+        i = 0
+        while i < len(chunk) and filled < nslots:
+            if filled < nfixed:
+                dest, typ = self.positionals[filled]
+                values[dest] = self._convert(dest, typ, chunk[i])
+                owners.append(filled)
+                i += 1
+            else:
+                values[self.varargs] = chunk[i:]
+                owners.extend([filled] * (len(chunk) - i))
+                i = len(chunk)
+            filled += 1
+        leftover = chunk[i:]
+        if separator is not None:
+            # argparse hands the "--" to the positional next to it, which
+            # drops it along with the first "--" among its own values; a
+            # "--" with no positional left to take it is unrecognized.
+            owner = separator - 1 if separator > 0 else separator
+            if owner >= i:
+                leftover.insert(max(separator - i, 0), "--")
+            elif owners[owner] < nfixed and owners[-1] == nfixed and \
+                    "--" in values[self.varargs]:
+                values[self.varargs].remove("--")
+        extras.extend(leftover)
+        return filled
+
+    def parse(self, tokens):
+        """Parse the argument tokens following the command word.
 
-cal = parsedatetime.Calendar()
+        Tokens are checked in the same order as argparse checks them, so a
+        line with several problems gets the error argparse would give.
+        """
+        values = {}
+        extras = []
+        chunk = []
+        filled = 0
+        i = 0
+        n = len(tokens)
+        while i < n:
+            token = tokens[i]
+            i += 1
+            if self._isValue(token):
+                chunk.append(token)
+                continue
+            if token == "--":
+                separator = len(chunk)
+                chunk.extend(tokens[i:])
+                filled = self._consumePositionals(chunk, separator, values,
+                                                  extras, filled)
+                chunk = None
+                break
+            filled = self._consumePositionals(chunk, None, values, extras,
+                                              filled)
+            chunk = []
+            explicit = None
+            if token.startswith("--"):
+                flag, eq, explicit = token.partition("=")
+                if not eq:
+                    explicit = None
+                spec = self._lookupLong(flag)
+            else:
+                spec = self._shortFlags.get(token[:2])
+                if len(token) > 2:
+                    explicit = token[2:]
+                    if explicit.startswith("="):
+                        explicit = explicit[1:]
+            if spec is None:
+                extras.append(token)
+                continue
+            if explicit is None:
+                if i >= n or not self._isValue(tokens[i]):
+                    raise ValueError("argument {}: expected one argument".format(
+                        self._argName(spec)))
+                explicit = tokens[i]
+                i += 1
+            values[spec[0]] = self._convert(self._argName(spec), spec[3], explicit)
+        if chunk is not None:
+            filled = self._consumePositionals(chunk, None, values, extras,
+                                              filled)
+
+        missing = [dest for dest, _ in self.positionals[filled:]]
+        if self.varargs is not None and self.varargs not in values:
+            missing.append(self.varargs)
+        for spec in self.options:
+            if spec[0] not in values:
+                if spec[4] is self._REQUIRED:
+                    missing.append(self._argName(spec))
+                else:
+                    values[spec[0]] = spec[4]
+        if missing:
+            raise ValueError("the following arguments are required: {}".format(
+                ", ".join(missing)))
+        if extras:
+            raise ValueError("unrecognized arguments: {}".format(
+                " ".join(extras)))
+        return self.Args(**values)
+
+
+_REQUIRED = FatscriptCommand._REQUIRED
+
+fatscriptCommands = {
+    "ingredient": FatscriptCommand("ingredient",
+        [("name", str)],
+        [("unit", "--unit", "-u", str, _REQUIRED),
+         ("amt", "--amt", "-a", float, _REQUIRED),
+         ("kcal", "--kcal", "-C", float, _REQUIRED),
+         ("carbs", "--carbs", "-c", float, _REQUIRED),
+         ("fat", "--fat", "-f", float, _REQUIRED),
+         ("protein", "--protein", "-p", float, _REQUIRED)]),
+    "combine": FatscriptCommand("combine",
+        [("name", str)],
+        [("amt", "--amt", "-a", float, 1.0),
+         ("unit", "--unit", "-u", str, "serving")],
+        varargs="ingredList"),
+    "eat": FatscriptCommand("eat",
+        [("time", float), ("item", str)],
+        [("amt", "--amt", "-a", float, 1.0)]),
+}
+
+_whitespace = " \t\r\n"
+_plainToken = re.compile(r"[^ \t\r\n]+")
+_fastEat = re.compile(
+        r"[ \t\r\n]*eat[ \t\r\n]+([^ \t\r\n\"'\\#-][^ \t\r\n\"'\\#]*)"
+        r"[ \t\r\n]+([^ \t\r\n\"'\\#-][^ \t\r\n\"'\\#]*)"
+        r"(?:[ \t\r\n]+--amt=([^ \t\r\n\"'\\#]+))?[ \t\r\n]*(?:#.*)?\Z",
+        re.S)
+_eatCommand = re.compile(r"[ \t\r\n]*eat[ \t\r\n]")
+
+def splitLine(line):
+    """Split a fatscript line into words, like shlex.split(line, comments=True).
+
+    Lines without quotes or escapes are split with a single regex; the rest go
+    through a POSIX shell-style state machine.
+    """
+    code = line.partition("#")[0]
+    if '"' not in code and "'" not in code and "\\" not in code:
+        return _plainToken.findall(code)
+    tokens = []
+    token = []
+    inToken = False
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        i += 1
+        if c in _whitespace:
+            if inToken:
+                tokens.append("".join(token))
+                token = []
+                inToken = False
+        elif c == "#":
+            break
+        elif c == "\\":
+            if i >= n:
+                raise ValueError("No escaped character")
+            token.append(line[i])
+            i += 1
+            inToken = True
+        elif c == "'":
+            end = line.find("'", i)
+            if end < 0:
+                raise ValueError("No closing quotation")
+            token.append(line[i:end])
+            i = end + 1
+            inToken = True
+        elif c == '"':
+            while True:
+                if i >= n:
+                    raise ValueError("No closing quotation")
+                c = line[i]
+                i += 1
+                if c == '"':
+                    break
+                elif c == "\\":
+                    if i >= n:
+                        raise ValueError("No escaped character")
+                    if line[i] not in '"\\':
+                        token.append(c)
+                    token.append(line[i])
+                    i += 1
+                else:
+                    token.append(c)
+            inToken = True
+        else:
+            token.append(c)
+            inToken = True
+    if inToken:
+        tokens.append("".join(token))
+    return tokens
+
+def parseLine(line):
+    """Parse one line of fatscript.
+
+    Returns
+    =======
+    None for blank and comment-only lines, otherwise a (command, args) pair,
+    where args is the command's namedtuple of parsed arguments.
+    """
+    fast = _fastEat.match(line)
+    if fast is not None:
+        try:
+            time = float(fast.group(1))
+            amt = 1.0 if fast.group(3) is None else float(fast.group(3))
+        except ValueError:
+            pass # let the general parser produce the error message
+        else:
+            return ("eat", _eatArgs(time, fast.group(2), amt))
+    args = splitLine(line)
+    if len(args) == 0:
+        return None
+    command = args[0]
+    if command not in fatscriptCommands:
+        raise ValueError("Unknown command: {}".format(command))
+    return (command, fatscriptCommands[command].parse(args[1:]))
 
-ingredParser = ThrowingArgumentParser(description="Define an ingredient")
-ingredParser.add_argument("name")
-ingredParser.add_argument("--unit", "-u", required=True)
-ingredParser.add_argument("--amt", "-a", type=float, required=True)
-ingredParser.add_argument("--kcal", "-C", type=float, required=True)
-ingredParser.add_argument("--carbs", "-c", type=float, required=True)
-ingredParser.add_argument("--fat", "-f", type=float, required=True)
-ingredParser.add_argument("--protein", "-p", type=float, required=True)
+_eatArgs = fatscriptCommands["eat"].Args
 
-combineParser = ThrowingArgumentParser(description="Define a combination")
-combineParser.add_argument("name")
-combineParser.add_argument("ingredList", nargs="+")
-combineParser.add_argument("--amt", "-a", type=float, default=1.0)
-combineParser.add_argument("--unit", "-u", default="serving")
+_calendar = None
 
-eatParser = ThrowingArgumentParser(description="Eat some food")
-eatParser.add_argument("time", type=float)
-eatParser.add_argument("item")
-eatParser.add_argument("--amt", "-a", type=float, default=1.0)
+def parseDate(text):
+    """Parse a natural language date, such as "two weeks ago"."""
+    global _calendar
+    if _calendar is None:
+        _calendar = parsedatetime.Calendar()
+    return _calendar.parseDT(text)[0]
 
 
 class Meal(namedtuple("Meal", ["time","name","amt","kcal","carbs","fat","protein"])):
@@ -105,6 +493,14 @@ class Meal(namedtuple("Meal", ["time","name","amt","kcal","carbs","fat","protein
             ))
 
 
+_statsFields = ["kcal", "carb_pct", "fat_pct", "protein_pct",
+                "carb_g", "fat_g", "protein_g"]
+TotalStats = namedtuple("TotalStats", _statsFields)
+MeanDailyStats = namedtuple("MeanDailyStats", _statsFields)
+Culprits = namedtuple("Culprits", ["kcal", "carbs", "fat", "protein"])
+BaseIngredients = namedtuple("BaseIngredients", ["indptr", "indices", "data"])
+
+
 class Ingredient(namedtuple("Ingredient", ["name","contents","unit","kcal","carbs","fat","protein"])):
 
     Sub = namedtuple("Sub", ["name", "amt"])
@@ -136,7 +532,10 @@ class Ingredient(namedtuple("Ingredient", ["name","contents","unit","kcal","carb
 
     @classmethod
     def fromArgs(cls, args):
-        parsed = ingredParser.parse_args(args)
+        return cls.fromParsed(fatscriptCommands["ingredient"].parse(args))
+
+    @classmethod
+    def fromParsed(cls, parsed):
         return cls(parsed.name,
                    (),
                    parsed.unit,
@@ -146,105 +545,1194 @@ class Ingredient(namedtuple("Ingredient", ["name","contents","unit","kcal","carb
                    parsed.protein / parsed.amt)
     
 
+def weightedRowSum(rows, weights):
+    """Sum of the rows of a matrix in some amounts, added up in row order."""
+    return (np.asarray(weights, dtype=float)[:, None] * rows).sum(axis=0)
+
+def recipeNutrients(rows, amounts, makes):
+    """Nutrients per unit of a recipe with amounts of the foods in rows.
+
+    The recipe makes makes units.  Its total is divided up after summing, the
+    order in which fat.py has always worked it out, down to the last digit.
+    """
+    return weightedRowSum(rows, amounts) * (1 / makes)
+
 def combine(name, ingredients, amounts, unit):
-    kcal = sum(i.kcal * a for i, a in zip(ingredients, amounts))
-    carbs = sum(i.carbs * a for i, a in zip(ingredients, amounts))
-    fat = sum(i.fat * a for i, a in zip(ingredients, amounts))
-    protein = sum(i.protein * a for i, a in zip(ingredients, amounts))
+    nutrients = weightedRowSum(np.array([i[3:7] for i in ingredients],
+                                        dtype=float).reshape(-1, 4), amounts)
     contents = tuple(Ingredient.Sub(i.name, a) for i, a in zip(ingredients, amounts))
-    return Ingredient(name, contents, unit, kcal, carbs, fat, protein)
+    return Ingredient(name, contents, unit, *nutrients.tolist())
+
+
+class IngredientTable:
+    """Every food defined so far, interned to integer ids in order of definition.
+
+    Names and units are kept in lists, the kcal, carbs, fat and protein per
+    unit of each food as the rows of one NumPy matrix, and what recipes are
+    made of in CSR arrays: one unit of food f contains contentAmts[j] units of
+    food contentIds[j] for j in contentPtr[f]:contentPtr[f+1].  A base
+    ingredient contains nothing.  The recipes are also kept as written, with
+    rawAmts[j] units of each food making makes[f] units of food f, to work
+    their nutrients out again when a food in them is redefined.
+
+    The table reads like a dict from food names to Ingredient objects, which
+    are only built when they are looked up.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.units = []
+        self.ids = {}
+        self.frozen = False
+        self._nutrients = np.zeros((64, 4))
+        self._contentPtr = np.zeros(65, dtype=np.intp)
+        self._contentIds = np.zeros(64, dtype=np.intp)
+        self._contentAmts = np.zeros(64)
+        self._rawAmts = np.zeros(64)
+        self._makes = np.ones(64)
+
+    @classmethod
+    def fromArrays(cls, names, units, nutrients, contentPtr, contentIds,
+                   contentAmts, rawAmts=None, makes=None):
+        """Build a table from the arrays of another table, as in a cache.
+
+        Without rawAmts and makes, each recipe is taken to make one unit.
+        """
+        table = cls()
+        table.names = list(names)
+        table.units = list(units)
+        table.ids = {name: i for i, name in enumerate(table.names)}
+        if len(table.ids) != len(table.names):
+            raise ValueError("Duplicate food names")
+        table._nutrients = np.array(nutrients, dtype=float).reshape(-1, 4)
+        table._contentPtr = np.array(contentPtr, dtype=np.intp)
+        table._contentIds = np.array(contentIds, dtype=np.intp)
+        table._contentAmts = np.array(contentAmts, dtype=float)
+        table._rawAmts = np.array(contentAmts if rawAmts is None else rawAmts,
+                                  dtype=float)
+        n = len(table.names)
+        table._makes = np.ones(n) if makes is None else \
+                np.array(makes, dtype=float)
+        if len(table._nutrients) != n or len(table._contentPtr) != n + 1 or \
+                len(table._contentIds) != table._contentPtr[-1] or \
+                len(table._contentAmts) != table._contentPtr[-1] or \
+                len(table._rawAmts) != table._contentPtr[-1] or \
+                len(table._makes) != n or np.any(table._contentIds >= n):
+            raise ValueError("Inconsistent ingredient table")
+        return table
+
+    @staticmethod
+    def _grow(array, size):
+        """array, or a copy with room for at least size rows."""
+        if size <= len(array):
+            return array
+        grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:],
+                         dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def add(self, name, unit, nutrients, contentIds=(), contentAmts=(),
+            rawAmts=None, makes=1.0):
+        """Define a food.
+
+        Parameters
+        ==========
+        name, unit : str
+        nutrients : sequence of float
+            kcal, carbs, fat and protein per unit
+        contentIds, contentAmts : sequence
+            ids and amounts of the foods in one unit of a recipe
+        rawAmts : sequence or None
+            amounts of the foods in the recipe as written, if not contentAmts
+        makes : float
+            units of the food that the recipe as written makes
+
+        Returns
+        =======
+        The food's id.
+        """
+        if self.frozen:
+            raise ValueError("Can't define \"{}\" in a frozen ingredient "
+                             "table".format(name))
+        food = len(self.names)
+        start = self._contentPtr[food]
+        end = start + len(contentIds)
+        self._nutrients = self._grow(self._nutrients, food + 1)
+        self._contentPtr = self._grow(self._contentPtr, food + 2)
+        self._contentIds = self._grow(self._contentIds, end)
+        self._contentAmts = self._grow(self._contentAmts, end)
+        self._rawAmts = self._grow(self._rawAmts, end)
+        self._makes = self._grow(self._makes, food + 1)
+        self._nutrients[food] = nutrients
+        self._contentIds[start:end] = contentIds
+        self._contentAmts[start:end] = contentAmts
+        self._rawAmts[start:end] = contentAmts if rawAmts is None else rawAmts
+        self._makes[food] = makes
+        self._contentPtr[food + 1] = end
+        self.names.append(name)
+        self.units.append(unit)
+        self.ids[name] = food
+        return food
+
+    def replace(self, food, unit, nutrients, contentIds=(), contentAmts=(),
+                rawAmts=None, makes=1.0):
+        """Redefine a food, keeping its id.
+
+        Recipes that contain the food are left as they are; see
+        recipesUsing and FoodDB.redefine.  Parameters are as for add.
+        """
+        if self.frozen:
+            raise ValueError("Can't redefine \"{}\" in a frozen ingredient "
+                             "table".format(self.names[food]))
+        n = len(self.names)
+        start, end = self._contentPtr[food:food + 2].tolist()
+        total = self._contentPtr[n]
+        self._contentIds = np.concatenate((self._contentIds[:start],
+                np.asarray(contentIds, dtype=np.intp),
+                self._contentIds[end:total]))
+        self._contentAmts = np.concatenate((self._contentAmts[:start],
+                np.asarray(contentAmts, dtype=float),
+                self._contentAmts[end:total]))
+        self._rawAmts = np.concatenate((self._rawAmts[:start],
+                np.asarray(contentAmts if rawAmts is None else rawAmts,
+                           dtype=float),
+                self._rawAmts[end:total]))
+        self._contentPtr[food + 1:n + 1] += len(contentIds) - (end - start)
+        self._makes[food] = makes
+        self._nutrients[food] = nutrients
+        self.units[food] = unit
+
+    def recipeNutrients(self, food):
+        """Work out the nutrients per unit of a recipe from its contents."""
+        start, end = self._contentPtr[food:food + 2].tolist()
+        return recipeNutrients(
+                self._nutrients[self._contentIds[start:end]],
+                self._rawAmts[start:end], self._makes[food])
+
+    def setNutrients(self, food, nutrients):
+        """Change the kcal, carbs, fat and protein per unit of a food."""
+        if self.frozen:
+            raise ValueError("Can't redefine \"{}\" in a frozen ingredient "
+                             "table".format(self.names[food]))
+        self._nutrients[food] = nutrients
+
+    def _owners(self):
+        """The recipe each entry of contentIds belongs to."""
+        return np.repeat(np.arange(len(self.names)), np.diff(self.contentPtr))
+
+    def recipesUsing(self, foods):
+        """Ids of the recipes that contain any of foods, directly or not.
+
+        This follows the edges of the dependency graph of the recipes
+        backwards, a level of recipes at a time.
+        """
+        contentIds = self.contentIds
+        owners = self._owners()
+        affected = np.zeros(len(self.names), dtype=bool)
+        frontier = np.asarray(foods, dtype=np.intp)
+        while len(frontier) > 0:
+            users = np.unique(owners[np.isin(contentIds, frontier)])
+            frontier = users[~affected[users]]
+            affected[frontier] = True
+        return np.flatnonzero(affected)
+
+    def topologicalOrder(self, foods=None):
+        """Foods ordered so that each recipe comes after the foods in it.
+
+        Foods are defined after what they contain, so ids are in order
+        unless a recipe has been redefined to use a later food.  Otherwise
+        this is Kahn's algorithm, taking the least id available each time.
+
+        Parameters
+        ==========
+        foods : sequence of int or None
+            the ids to order, only considering the dependencies among them,
+            or None for all foods
+
+        Raises
+        ======
+        ValueError
+            if some recipes contain each other
+        """
+        n = len(self.names)
+        if foods is None:
+            foods = np.arange(n)
+        foods = np.unique(np.asarray(foods, dtype=np.intp))
+        contentIds = self.contentIds
+        owners = self._owners()
+        if np.all(contentIds < owners):
+            return foods
+        member = np.zeros(n, dtype=bool)
+        member[foods] = True
+        inside = member[owners] & member[contentIds]
+        owners = owners[inside]
+        contentIds = contentIds[inside]
+        pending = np.bincount(owners, minlength=n)
+        order = np.argsort(contentIds, kind="stable")
+        usersPtr = np.searchsorted(contentIds[order], np.arange(n + 1))
+        users = owners[order].tolist()
+        pending = pending.tolist()
+        ready = [f for f in foods.tolist() if pending[f] == 0]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            food = heapq.heappop(ready)
+            result.append(food)
+            for user in users[usersPtr[food]:usersPtr[food + 1]]:
+                pending[user] -= 1
+                if pending[user] == 0:
+                    heapq.heappush(ready, user)
+        if len(result) < len(foods):
+            cycle = sorted(set(foods.tolist()) - set(result))
+            raise ValueError("Recipes contain each other: {}".format(
+                    ", ".join(self.names[f] for f in cycle)))
+        return np.array(result, dtype=np.intp)
+
+    def freeze(self):
+        """Make the table immutable, so that FoodDBs can share it.
+
+        Returns
+        =======
+        The table itself.
+        """
+        self._nutrients = self.nutrients
+        self._contentPtr = self.contentPtr
+        self._contentIds = self.contentIds
+        self._contentAmts = self.contentAmts
+        self._rawAmts = self.rawAmts
+        self._makes = self.makes
+        for array in (self._nutrients, self._contentPtr, self._contentIds,
+                      self._contentAmts, self._rawAmts, self._makes):
+            array.setflags(write=False)
+        self.frozen = True
+        return self
+
+    def copy(self):
+        """A mutable copy of the table."""
+        return self.fromArrays(self.names, self.units, self.nutrients,
+                               self.contentPtr, self.contentIds,
+                               self.contentAmts, self.rawAmts, self.makes)
+
+    @property
+    def nutrients(self):
+        """Matrix of kcal, carbs, fat and protein per unit, one row per food."""
+        return self._nutrients[:len(self.names)]
+
+    @property
+    def contentPtr(self):
+        return self._contentPtr[:len(self.names) + 1]
+
+    @property
+    def contentIds(self):
+        return self._contentIds[:self._contentPtr[len(self.names)]]
+
+    @property
+    def contentAmts(self):
+        return self._contentAmts[:self._contentPtr[len(self.names)]]
+
+    @property
+    def rawAmts(self):
+        return self._rawAmts[:self._contentPtr[len(self.names)]]
+
+    @property
+    def makes(self):
+        return self._makes[:len(self.names)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        food = self.ids[name]
+        start, end = self._contentPtr[food:food + 2].tolist()
+        contents = tuple(Ingredient.Sub(self.names[c], a) for c, a in zip(
+                self._contentIds[start:end].tolist(),
+                self._contentAmts[start:end].tolist()))
+        return Ingredient(name, contents, self.units[food],
+                          *self._nutrients[food].tolist())
+
+    def values(self):
+        return (self[name] for name in self.names)
+
+
+class MealLog:
+    """Time-sorted meal log stored as NumPy columns.
+
+    Meals are kept as parallel arrays: time (float64 epoch seconds), food (ids
+    indexing into names), amt, and nutrients (one row of kcal, carbs, fat and
+    protein per meal).  Meal objects are only materialized when the log is
+    indexed or iterated, and slicing returns a MealLog of views into the same
+    columns.
+    """
+
+    def __init__(self, time, food, amt, nutrients, names):
+        self.time = time
+        self.food = food
+        self.amt = amt
+        self.nutrients = nutrients
+        self.names = names
+
+    @classmethod
+    def empty(cls, names=()):
+        return cls(np.zeros(0), np.zeros(0, dtype=np.intp), np.zeros(0),
+                   np.zeros((0, 4)), names)
+
+    @property
+    def kcal(self):
+        return self.nutrients[:, 0]
+
+    @property
+    def carbs(self):
+        return self.nutrients[:, 1]
+
+    @property
+    def fat(self):
+        return self.nutrients[:, 2]
+
+    @property
+    def protein(self):
+        return self.nutrients[:, 3]
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return type(self)(self.time[key], self.food[key], self.amt[key],
+                              self.nutrients[key], self.names)
+        return Meal(self.time[key].item(),
+                    self.names[self.food[key]],
+                    self.amt[key].item(),
+                    *self.nutrients[key].tolist())
+
+    def __iter__(self):
+        names = self.names
+        for time, food, amt, nutrients in zip(self.time.tolist(),
+                self.food.tolist(), self.amt.tolist(), self.nutrients.tolist()):
+            yield Meal(time, names[food], amt, *nutrients)
+
+    def timeRange(self, begin, end):
+        """Meals eaten after begin and up to and including end.
+
+        The time column is sorted, so this is a binary search and a slice; the
+        result shares this log's storage.
+
+        Parameters
+        ==========
+        begin, end : float
+            epoch timestamps
+        """
+        first, after = np.searchsorted(self.time, (begin, end), side="right")
+        return self[first:after]
+
+    def foodsByFirstAppearance(self):
+        """Ids of the foods in this log, in the order they were first eaten."""
+        ids, first = np.unique(self.food, return_index=True)
+        return ids[np.argsort(first, kind="stable")]
+
+
+def sortedRun(time, *columns):
+    """Sort meal columns by time, keeping the order of equal times."""
+    order = np.argsort(time, kind="stable")
+    return (time[order],) + tuple(c[order] for c in columns)
+
+def mergeTwoRuns(a, b, tiebreak=None):
+    """Stable merge of two runs of meal columns that are sorted by time.
+
+    Parameters
+    ==========
+    a, b : tuple of ndarray
+        the runs' columns, time first
+    tiebreak : int or None
+        index of a column that orders meals with equal times in both runs,
+        or None to put meals from a first among equal times
+
+    Returns
+    =======
+    merged : tuple of ndarray
+        the columns of a and b merged, with meals from a first among meals
+        that are equal in time and tiebreak
+    fromB : ndarray of bool
+        which of the merged meals came from b
+    """
+    n = len(a[0]) + len(b[0])
+    where = np.searchsorted(a[0], b[0], side="right")
+    if tiebreak is not None:
+        first = np.searchsorted(a[0], b[0], side="left")
+        for i in np.flatnonzero(where > first).tolist():
+            where[i] = first[i] + np.searchsorted(
+                    a[tiebreak][first[i]:where[i]], b[tiebreak][i],
+                    side="right")
+    where += np.arange(len(b[0]))
+    fromB = np.zeros(n, dtype=bool)
+    fromB[where] = True
+    merged = []
+    for colA, colB in zip(a, b):
+        col = np.empty((n,) + colA.shape[1:], dtype=colA.dtype)
+        col[~fromB] = colA
+        col[where] = colB
+        merged.append(col)
+    return tuple(merged), fromB
+
+def mergeRuns(runs):
+    """Stable k-way merge of runs of meal columns that are sorted by time.
+
+    Runs are merged pairwise in a balanced tree, and meals with equal times
+    keep the order of the runs they came from.
+    """
+    while len(runs) > 1:
+        runs = [mergeTwoRuns(*runs[i:i+2])[0] if i + 1 < len(runs) else runs[i]
+                for i in range(0, len(runs), 2)]
+    return runs[0]
+
+def decodeLines(data):
+    """Iterate over the lines of a fatscript file's contents, like open()."""
+    return io.TextIOWrapper(io.BytesIO(data))
+
+
+CACHE_VERSION = 8
+
+def cachePath(filenames):
+    """Path of the compiled cache for a list of fatscript files.
+
+    The cache is a hidden sidecar next to the first file, named after it and a
+    digest of the whole file list, so that different combinations of files
+    each keep their own cache.
+    """
+    paths = [os.path.abspath(fn) for fn in filenames]
+    digest = hashlib.sha1("\0".join(paths).encode()).hexdigest()[:12]
+    head, tail = os.path.split(paths[0])
+    return os.path.join(head, ".{}.{}.fatcache".format(tail, digest))
+
+# How much of a file has been loaded: its path, the number of bytes and lines
+# consumed, the SHA-1 of those bytes, and the file's modification time then.
+Checkpoint = namedtuple("Checkpoint",
+                        ["path", "offset", "lines", "sha1", "mtime_ns"])
+
+def readTail(fn, checkpoint=None):
+    """Read the part of a file that comes after a checkpoint.
+
+    Parameters
+    ==========
+    fn : str
+        file name
+    checkpoint : Checkpoint or None
+        what was read before, or None to read the whole file
+
+    Returns
+    =======
+    None if the file no longer begins with the bytes the checkpoint covers,
+    otherwise a pair of the bytes after the checkpoint and a new Checkpoint
+    covering the whole file.  A checkpoint that ends in the middle of a line
+    no longer holds once that line has been continued.  If the file still
+    has the size and modification time it had at the checkpoint, it isn't
+    read at all.
+    """
+    if checkpoint is None:
+        checkpoint = Checkpoint(os.path.abspath(fn), 0, 0,
+                                hashlib.sha1().hexdigest(), None)
+    sha = hashlib.sha1()
+    with open(fn, "rb") as file:
+        st = os.fstat(file.fileno())
+        if st.st_size == checkpoint.offset and \
+                st.st_mtime_ns == checkpoint.mtime_ns:
+            return b"", checkpoint
+        prefix = file.read(checkpoint.offset)
+        sha.update(prefix)
+        if len(prefix) != checkpoint.offset or sha.hexdigest() != checkpoint.sha1:
+            return None
+        tail = file.read()
+    if prefix and not prefix.endswith(b"\n") and tail and \
+            not tail.startswith(b"\n"):
+        return None
+    sha.update(tail)
+    return tail, Checkpoint(checkpoint.path, checkpoint.offset + len(tail),
+                            checkpoint.lines + tail.count(b"\n"),
+                            sha.hexdigest(), st.st_mtime_ns)
+
+
+_mealWorkerState = None
+
+def _initMealWorker(foodIds, defined):
+    global _mealWorkerState
+    _mealWorkerState = (foodIds, defined)
+
+def _parseMeals(task):
+    """Parse the eat lines of one file in a FoodDB._integrateParallel worker.
+
+    Returns
+    =======
+    The sorted time, food, amt and file index columns of the meals, and the
+    first error as ((file index, line number), file name, line, message), or
+    None.
+    """
+    fileIdx, fn, data, first = task
+    foodIds, defined = _mealWorkerState
+    times = []
+    foods = []
+    amts = []
+    error = None
+    for lineno, line in enumerate(decodeLines(data), first):
+        try:
+            parsed = parseLine(line)
+            if parsed is None or parsed[0] != "eat":
+                continue
+            args = parsed[1]
+            if defined.get(args.item, (fileIdx, lineno)) >= (fileIdx, lineno):
+                raise ValueError("Unknown food: \"{}\"".format(args.item))
+        except Exception as e:
+            error = ((fileIdx, lineno), fn, line, str(e))
+            break
+        times.append(args.time)
+        foods.append(foodIds[args.item])
+        amts.append(args.amt)
+    run = sortedRun(np.array(times, dtype=float),
+                    np.array(foods, dtype=np.intp),
+                    np.array(amts, dtype=float),
+                    np.full(len(times), fileIdx, dtype=np.intp))
+    return run + (error,)
+
+# A meal as stored in the temporary runs of externalSort
+_mealRecord = [("time", "<f8"), ("food", "<i8"), ("amt", "<f8")]
+
+def fileMeals(fn, foodIds, begin, end):
+    """Stream the meals of a fatscript file that fall in an interval.
+
+    Only eat lines are parsed, so the file must already have been checked by
+    loading it, and meals outside the interval are dropped straight away.
+
+    Parameters
+    ==========
+    fn : str
+        file name
+    foodIds : dict
+        food id of each food name
+    begin, end : float
+        epoch timestamps; meals eaten after begin and up to and including end
+        are kept
+
+    Returns
+    =======
+    Iterator of (time, food id, amt) tuples, in file order.
+    """
+    with open(fn) as file:
+        for line in file:
+            if not _eatCommand.match(line):
+                continue
+            args = parseLine(line)[1]
+            if begin < args.time <= end:
+                yield (args.time, foodIds[args.item], args.amt)
+
+def _readRun(file, blockSize=4096):
+    """Read back a run of meals written by externalSort, a block at a time."""
+    file.seek(0)
+    while True:
+        itemsize = np.dtype(_mealRecord).itemsize
+        block = np.frombuffer(file.read(blockSize * itemsize),
+                              dtype=_mealRecord)
+        if len(block) == 0:
+            return
+        yield from block.tolist()
+
+def externalSort(meals, runSize=100000):
+    """Sort a stream of meals by time, holding at most runSize meals in memory.
+
+    The meals are sorted in runs of runSize, which are written to temporary
+    files unless there is only one, and then merged.  Meals with equal times
+    keep their order.
+
+    Parameters
+    ==========
+    meals : iterable of (time, food id, amt)
+        meals in any order
+
+    Returns
+    =======
+    Iterator of (time, food id, amt) tuples in time order.
+    """
+    runs = []
+    try:
+        while True:
+            chunk = np.array(list(itertools.islice(meals, runSize)),
+                             dtype=_mealRecord)
+            chunk = chunk[np.argsort(chunk["time"], kind="stable")]
+            if len(runs) == 0 and len(chunk) < runSize:
+                yield from chunk.tolist()
+                return
+            if len(chunk) == 0:
+                break
+            runs.append(tempfile.TemporaryFile())
+            runs[-1].write(chunk.tobytes())
+        yield from heapq.merge(*(_readRun(run) for run in runs),
+                               key=lambda meal: meal[0])
+    finally:
+        for run in runs:
+            run.close()
+
+
+class Profiler:
+    """Wall time and call counts of the phases of a fat.py run, plus counters.
+
+    FoodDB and the report functions time their phases with
+    `with profiler.phase(name):` and count things like lines parsed with
+    profiler.count.  A disabled Profiler, which FoodDB uses by default,
+    records nothing.  Phases timed in several threads at once, as by
+    doReports, add up to more than the wall time.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def phase(self, name):
+        """Context manager that adds its wall time to the named phase."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                calls, total = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (calls + 1, total + seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def asDict(self):
+        return {"phases": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in self.phases.items()},
+                "counters": dict(self.counters)}
+
+    def __str__(self):
+        lines = ["{:32} {:>8} {:>10}".format("phase", "calls", "seconds")]
+        for name, (calls, seconds) in self.phases.items():
+            lines.append("{:32} {:8d} {:10.4f}".format(name, calls, seconds))
+        lines.append("")
+        lines.append("{:32} {:>8}".format("counter", "value"))
+        for name, value in self.counters.items():
+            lines.append("{:32} {:8d}".format(name, value))
+        return "\n".join(lines)
+
+nullProfiler = Profiler(enabled=False)
 
 
 class FoodDB:
-    def __init__(self, filenames=[]):
-        self.ingredients = {}
-        self.eaten = []
-        self._integrateFiles(filenames)
+    # The FoodDB a filteredRange view was made from, or None
+    _root = None
+
+    def __init__(self, filenames=[], cache=False, jobs=1, profiler=None,
+                 library=None):
+        """Load a FoodDB from fatscript files.
+
+        Parameters
+        ==========
+        filenames : list of str
+            fatscript files, read in order
+        cache : bool
+            Load from, and save to, the compiled cache beside the files (see
+            cachePath) instead of always parsing them.  Lines appended to the
+            files since the cache was written are parsed into the cached
+            tables; if a file was changed anywhere else, or the cache is
+            unreadable, everything is parsed again and the cache rebuilt.
+        jobs : int
+            Number of processes to parse multiple files with.
+        profiler : Profiler or None
+            Record the time spent loading and reporting in this Profiler.
+        library : FoodDB or None
+            Foods to load the files against, as if they were defined at the
+            top of the first file, but not its meals.  The library's
+            ingredient table is frozen and shared, so loading many FoodDBs
+            against one library costs no copies of it, unless the files
+            define foods of their own.  The compiled cache isn't used with a
+            library.
+        """
+        self.jobs = jobs
+        self.profiler = profiler or nullProfiler
+        self.library = library
+        if library is not None:
+            library.ingredients.freeze()
+        self._clear()
+        if cache and len(filenames) > 0 and library is None:
+            self._integrateCached(filenames)
+        else:
+            self._integrateFiles(filenames)
         if len(self.eaten) > 0:
-            self.begin = datetime.fromtimestamp(self.eaten[0].time)
+            self.begin = datetime.fromtimestamp(self.eaten.time[0])
         else:
             self.begin = datetime.fromtimestamp(0)
         self.end = datetime.now()
 
+    def _clear(self):
+        if self.library is None:
+            self.ingredients = IngredientTable()
+            self._derived = {}
+        else:
+            self.ingredients = self.library.ingredients
+            self._derived = dict(self.library._derived)
+        self._pending = ([], [], [])
+        self.eaten = MealLog.empty(self.ingredients.names)
+        # The index of the file each food was defined in, and of the file
+        # each meal of self.eaten came from, to load appended lines as if
+        # the files had been loaded in full.  The library's foods come
+        # before every file.
+        self._definedIn = [-1] * len(self.ingredients)
+        self._mealFiles = np.zeros(0, dtype=np.intp)
+        self._pendingFiles = []
+        self._fileIdx = 0
+
     def formatIngredients(self):
-        return "\n".join("  " + str(i) for i in sorted(self.ingredients.values(), key=lambda x: x.name))
+        out = io.StringIO()
+        writeIngredients(self.ingredients, out)
+        return out.getvalue()[:-1]
 
     def formatEaten(self):
-        return "\n".join("  " + str(e) for e in self.eaten)
+        out = io.StringIO()
+        writeEaten(self.eaten, out)
+        return out.getvalue()[:-1]
 
     def __str__(self):
-        span = "{} to {}".format(self.begin, self.end)
-        ingred = self.formatIngredients()
-        eaten = self.formatEaten()
-        return "{}\nIngredients:\n{}\nEaten:\n{}".format(span, ingred, eaten)
+        out = io.StringIO()
+        doDump(self, out)
+        return out.getvalue()[:-1]
 
     def _parseLine(self, line):
-        args = shlex.split(line, comments=True)
-        if len(args) == 0:
+        self._accumulate(parseLine(line))
+
+    def _accumulate(self, parsed):
+        if parsed is None:
             return
-        command = args[0]
-        commandArgs = args[1:]
+        command, args = parsed
         if command == "ingredient":
-            self._accumIngredient(commandArgs)
+            self._accumIngredient(args)
         elif command == "combine":
-            self._accumCombine(commandArgs)
+            self._accumCombine(args)
         elif command == "eat":
-            self._accumEat(commandArgs)
-        else:
-            raise ValueError("Unknown command: {}".format(command))
+            self._accumEat(args)
 
-    def _accumIngredient(self, args):
-        newIngred = Ingredient.fromArgs(args)
-        if newIngred.name in self.ingredients:
+    def _accumIngredient(self, parsed):
+        if parsed.name in self.ingredients:
             raise ValueError("Duplicate definition of \"{}\"".format(
-                newIngred.name))
-        self.ingredients[newIngred.name] = newIngred
+                parsed.name))
+        self._define(parsed.name, parsed.unit,
+                     [parsed.kcal / parsed.amt, parsed.carbs / parsed.amt,
+                      parsed.fat / parsed.amt, parsed.protein / parsed.amt])
+
+    def _define(self, name, unit, nutrients, contentIds=(), contentAmts=(),
+                rawAmts=None, makes=1.0):
+        if self.ingredients.frozen:
+            # Shared with other FoodDBs, see __init__
+            self.ingredients = self.ingredients.copy()
+        self.ingredients.add(name, unit, nutrients, contentIds, contentAmts,
+                             rawAmts, makes)
+        self._definedIn.append(self._fileIdx)
+        self._derived.clear()
+
+    def _derivedTable(self, key, build):
+        """Memoize a table derived from the ingredient table.
+
+        The memo is shared by every view of this FoodDB, and cleared whenever
+        a food is defined.
+        """
+        if key not in self._derived:
+            self._derived[key] = build()
+        return self._derived[key]
+
+    def _recipe(self, parsed):
+        """The nutrients and contents of one unit of a combine command's food.
 
-    def _accumCombine(self, args):
-        parsed = combineParser.parse_args(args)
+        Returns
+        =======
+        nutrients : ndarray
+            kcal, carbs, fat and protein per unit
+        components, amounts : list
+            ids and amounts per unit of the foods in the recipe
+        rawAmounts : list
+            amounts of the foods in the recipe as written
+        """
         try:
-            components = [self.ingredients[x] for x in parsed.ingredList[::2]]
+            components = [self.ingredients.ids[x]
+                          for x in parsed.ingredList[::2]]
         except KeyError as e:
             raise ValueError("Unknown ingredient {}".format(e))
         amounts = [float(a) for a in parsed.ingredList[1::2]]
         if len(components) != len(amounts):
             raise ValueError("Every ingredient must be paired with an amount")
+        scale = 1/parsed.amt
+        return (recipeNutrients(self.ingredients.nutrients[components],
+                                amounts, parsed.amt),
+                components, [a * scale for a in amounts], amounts)
+
+    def _accumCombine(self, parsed):
+        nutrients, components, amounts, rawAmounts = self._recipe(parsed)
         if parsed.name in self.ingredients:
             raise ValueError("Food name conflict \"{}\"".format(parsed.name))
-        newIngred = combine(parsed.name, components, amounts, parsed.unit)
-        newIngred = 1/parsed.amt * newIngred
-        self.ingredients[newIngred.name] = newIngred
+        self._define(parsed.name, parsed.unit, nutrients, components, amounts,
+                     rawAmounts, parsed.amt)
 
-    def _accumEat(self, args):
-        parsed = eatParser.parse_args(args)
-        if parsed.item not in self.ingredients:
+    def redefine(self, line):
+        """Change the definition of a food, and of everything made from it.
+
+        The food keeps its id.  The recipes that contain it, directly or
+        through other recipes, are worked out again in dependency order, and
+        then the nutrients of the meals of any of them, so the FoodDB ends up
+        as if the food had been defined this way in the first place.  Views
+        from filteredRange share the change, and redefining a food in a view
+        redefines it in the whole FoodDB the view was made from.
+
+        Parameters
+        ==========
+        line : str
+            An ingredient or combine command, as in fatscript, for a food
+            that is already defined.  A recipe may use foods defined after
+            it, but not the recipes that contain it.
+        """
+        if self._root is not None:
+            # The view's meals are a slice of the root's, so updating the
+            # root's meal log updates them too
+            self._root.redefine(line)
+            self.ingredients = self._root.ingredients
+            return
+        parsed = parseLine(line)
+        if parsed is None or parsed[0] not in ("ingredient", "combine"):
+            raise ValueError("Only an ingredient or combine command can "
+                             "redefine a food")
+        command, args = parsed
+        if args.name not in self.ingredients:
+            raise ValueError("Unknown food: \"{}\"".format(args.name))
+        food = self.ingredients.ids[args.name]
+        if command == "ingredient":
+            nutrients = [args.kcal / args.amt, args.carbs / args.amt,
+                         args.fat / args.amt, args.protein / args.amt]
+            components, amounts, rawAmounts, makes = [], [], None, 1.0
+        else:
+            nutrients, components, amounts, rawAmounts = self._recipe(args)
+            makes = args.amt
+            containing = self.ingredients.recipesUsing([food])
+            if food in components or np.isin(components, containing).any():
+                raise ValueError("Recipe cycle: \"{}\" would contain "
+                                 "itself".format(args.name))
+        if self.ingredients.frozen:
+            # Shared with other FoodDBs, see __init__
+            self.ingredients = self.ingredients.copy()
+        table = self.ingredients
+        table.replace(food, args.unit, nutrients, components, amounts,
+                      rawAmounts, makes)
+        self._derived.clear()
+        affected = table.recipesUsing([food])
+        self.profiler.count("recipe re-evaluations", len(affected))
+        for recipe in table.topologicalOrder(affected).tolist():
+            table.setNutrients(recipe, table.recipeNutrients(recipe))
+        eaten = self.eaten
+        stale = np.isin(eaten.food, np.append(affected, food))
+        eaten.nutrients[stale] = eaten.amt[stale, None] * \
+                table.nutrients[eaten.food[stale]]
+
+    def _accumEat(self, parsed):
+        food = self.ingredients.ids.get(parsed.item)
+        # A food from the cache may be defined in a later file
+        if food is None or self._definedIn[food] > self._fileIdx:
             raise ValueError("Unknown food: \"{}\"".format(parsed.item))
-        ingredItem = self.ingredients[parsed.item]
-        meal = Meal(parsed.time,
-                    parsed.item,
-                    parsed.amt,
-                    parsed.amt * ingredItem.kcal,
-                    parsed.amt * ingredItem.carbs,
-                    parsed.amt * ingredItem.fat,
-                    parsed.amt * ingredItem.protein)
-        self.eaten.append(meal)
+        times, foods, amts = self._pending
+        times.append(parsed.time)
+        foods.append(food)
+        amts.append(parsed.amt)
+
+    def _foodNutrients(self):
+        """Matrix of kcal, carbs, fat and protein per unit, one row per food id."""
+        return self.ingredients.nutrients
+
+    def _baseIngredients(self):
+        """Decomposition of every food into base ingredients.
+
+        Returns
+        =======
+        The food × base ingredient matrix in CSR form, as a BaseIngredients.
+        Row f holds the amount of each base ingredient in one unit of food f,
+        in depth-first order of its recipe tree.  A base ingredient's row is
+        just itself.
+        """
+        def build():
+            rows = [None] * len(self.ingredients)
+            ptr = self.ingredients.contentPtr.tolist()
+            contentIds = self.ingredients.contentIds.tolist()
+            contentAmts = self.ingredients.contentAmts.tolist()
+            self.profiler.count("recipe expansions", len(contentIds))
+            for food in self.ingredients.topologicalOrder().tolist():
+                if ptr[food] == ptr[food + 1]:
+                    rows[food] = {food: 1.0}
+                    continue
+                row = {}
+                for sub, subAmt in zip(contentIds[ptr[food]:ptr[food + 1]],
+                                       contentAmts[ptr[food]:ptr[food + 1]]):
+                    # in topological order, the component's row is built
+                    for leaf, amt in rows[sub].items():
+                        row[leaf] = row.get(leaf, 0.0) + subAmt * amt
+                rows[food] = row
+            indptr = np.cumsum([0] + [len(r) for r in rows])
+            return BaseIngredients(indptr,
+                    np.fromiter((l for r in rows for l in r), dtype=np.intp,
+                                count=indptr[-1]),
+                    np.fromiter((a for r in rows for a in r.values()),
+                                dtype=float, count=indptr[-1]))
+        return self._derivedTable("baseIngredients", build)
+
+    def _mergePending(self, runs=()):
+        """Merge new meals into the sorted meal log.
+
+        Parameters
+        ==========
+        runs : list of (time, food, amt, file index) arrays
+            runs of meals, each already sorted by time, to merge in along with
+            the meals accumulated by _accumEat
+        """
+        with self.profiler.phase("sort"):
+            self._sortPending(runs)
+
+    def _sortPending(self, runs):
+        times, foods, amts = self._pending
+        starts, fileIdxs = zip(*self._pendingFiles) if self._pendingFiles \
+                else ((), ())
+        self._pending = ([], [], [])
+        self._pendingFiles = []
+        pending = sortedRun(np.array(times, dtype=float),
+                            np.array(foods, dtype=np.intp),
+                            np.array(amts, dtype=float),
+                            np.repeat(np.array(fileIdxs, dtype=np.intp),
+                                      np.diff(starts + (len(times),))))
+        new = mergeRuns(list(runs) + [pending])
+        if len(new[0]) == 0:
+            return
+        self.profiler.count("meals created", len(new[0]))
+        # Meals with equal times are in file order, and within a file in
+        # line order, so appended lines go after the cached meals of their
+        # own file but before those of later files
+        (time, food, amt, self._mealFiles), isNew = mergeTwoRuns(
+                (self.eaten.time, self.eaten.food, self.eaten.amt,
+                 self._mealFiles), new, tiebreak=3)
+        # Only compute nutrients for the new meals
+        nutrients = np.empty((len(time), 4))
+        nutrients[~isNew] = self.eaten.nutrients
+        nutrients[isNew] = new[2][:, None] * self._foodNutrients()[new[1]]
+        self.eaten = MealLog(time, food, amt, nutrients, self.ingredients.names)
+
+    def _reportError(self, fn, lineno, line, e):
+        raise FatscriptError("ERROR {} line {}: \"{}\", {}".format(
+            fn, lineno, line.strip(), e))
+
+    def _integrateLines(self, fn, lines, firstLineno=0, fileIdx=0):
+        self._fileIdx = fileIdx
+        self._pendingFiles.append((len(self._pending[0]), fileIdx))
+        lineno = firstLineno - 1
+        with self.profiler.phase("parse {}".format(fn)):
+            for lineno, line in enumerate(lines, firstLineno):
+                try:
+                    self._parseLine(line)
+                except Exception as e:
+                    self._reportError(fn, lineno, line, e)
+        self.profiler.count("files")
+        self.profiler.count("lines parsed", lineno + 1 - firstLineno)
 
     def _integrateFiles(self, filenames):
-        lines = []
-        for fn in filenames:
+        if self.jobs > 1 and len(filenames) > 1:
+            sources = []
+            for fn in filenames:
+                with open(fn, "rb") as file:
+                    sources.append((fn, file.read(), 0))
+            self._integrateParallel(sources)
+            return
+        for fileIdx, fn in enumerate(filenames):
             with open(fn) as file:
-                for lineno, line in enumerate(file):
+                self._integrateLines(fn, file, 0, fileIdx)
+        self._mergePending()
+
+    def _integrateParallel(self, sources):
+        """Load fatscript with a process pool.
+
+        First the ingredient and combine lines of all sources are applied in
+        order, then the meals of each source are parsed in a separate process,
+        and the sorted per-source runs are merged into the meal log.  Errors
+        are reported for the first bad line, as in a serial load.
+
+        Parameters
+        ==========
+        sources : list of (filename, bytes, first line number)
+            file contents to parse, one for each file in order
+        """
+        # Where each food was defined, so that workers can reject meals of
+        # foods that are only defined later on, like a serial load does.
+        defined = {name: (fileIdx, -1) for name, fileIdx in
+                   zip(self.ingredients.names, self._definedIn)}
+        errors = []
+        with self.profiler.phase("parse definitions"):
+            for fileIdx, (fn, data, first) in enumerate(sources):
+                self._fileIdx = fileIdx
+                for lineno, line in enumerate(decodeLines(data), first):
+                    if _eatCommand.match(line):
+                        continue
                     try:
-                        self._parseLine(line)
+                        parsed = parseLine(line)
+                        if parsed is not None and parsed[0] != "eat":
+                            self._accumulate(parsed)
+                            defined[parsed[1].name] = (fileIdx, lineno)
                     except Exception as e:
-                        print("ERROR {} line {}: \"{}\", {}".format(
-                            fn, lineno, line.strip(), e),
-                            file=sys.stderr)
-                        exit(1)
-        self.eaten.sort(key=lambda m: m.time)
+                        errors.append(((fileIdx, lineno), fn, line, str(e)))
+                        break
+                if errors:
+                    break
+        self.profiler.count("files", len(sources))
+        self.profiler.count("lines parsed",
+                            sum(data.count(b"\n") for _, data, _ in sources))
+        tasks = [(fileIdx, fn, data, first)
+                 for fileIdx, (fn, data, first) in enumerate(sources)]
+        with self.profiler.phase("parse meals"), \
+                concurrent.futures.ProcessPoolExecutor(self.jobs,
+                    initializer=_initMealWorker,
+                    initargs=(self.ingredients.ids, defined)) as pool:
+            results = list(pool.map(_parseMeals, tasks))
+        errors.extend(error for *_, error in results if error is not None)
+        if errors:
+            (_, lineno), fn, line, e = min(errors, key=lambda error: error[0])
+            self._reportError(fn, lineno, line, e)
+        self._mergePending([run for *run, _ in results])
+
+    def _integrateCached(self, filenames):
+        """Load files through the compiled cache, parsing only what's new."""
+        path = cachePath(filenames)
+        with self.profiler.phase("read cache"):
+            checkpoints = self._loadCache(path, filenames)
+        tails = None
+        with self.profiler.phase("read files"):
+            if checkpoints is not None:
+                tails = [readTail(fn, cp)
+                         for fn, cp in zip(filenames, checkpoints)]
+                if None in tails:
+                    self._clear()
+                    tails = None
+            if tails is None:
+                checkpoints = [None] * len(filenames)
+                tails = [readTail(fn) for fn in filenames]
+        sources = [(fn, tail, 0 if old is None else old.lines)
+                   for fn, (tail, _), old in zip(filenames, tails, checkpoints)]
+        if self.jobs > 1 and sum(len(tail) > 0 for _, tail, _ in sources) > 1:
+            self._integrateParallel(sources)
+        else:
+            for fileIdx, (fn, tail, first) in enumerate(sources):
+                if len(tail) > 0:
+                    self._integrateLines(fn, decodeLines(tail), first, fileIdx)
+            self._mergePending()
+        # Also save new modification times, so unchanged files that were
+        # touched aren't hashed again every time
+        if [cp for _, cp in tails] != checkpoints:
+            with self.profiler.phase("write cache"):
+                self._saveCache(path, [cp for _, cp in tails])
+
+    def _loadCache(self, path, filenames):
+        """Fill in the tables from a compiled cache of the files.
+
+        Returns
+        =======
+        The Checkpoint of each file saved with the cache, or None if the cache
+        is missing or corrupt.
+        """
+        try:
+            with np.load(path, allow_pickle=False) as cached:
+                meta = json.loads(str(cached["meta"]))
+                if meta["version"] != CACHE_VERSION:
+                    return None
+                checkpoints = [Checkpoint(*cp) for cp in meta["files"]]
+                if [cp.path for cp in checkpoints] != \
+                        [os.path.abspath(fn) for fn in filenames]:
+                    return None
+                ingredients = IngredientTable.fromArrays(
+                        cached["ingred_name"].tolist(),
+                        cached["ingred_unit"].tolist(),
+                        cached["ingred_nutrients"],
+                        cached["contents_ptr"],
+                        cached["contents_id"],
+                        cached["contents_amt"],
+                        cached["contents_raw_amt"],
+                        cached["ingred_makes"])
+                eaten = MealLog(cached["eaten_time"],
+                                cached["eaten_food"].astype(np.intp),
+                                cached["eaten_amt"],
+                                cached["eaten_nutrients"],
+                                ingredients.names)
+                definedIn = cached["ingred_file"].tolist()
+                mealFiles = cached["eaten_file"].astype(np.intp)
+                if len(eaten.time) and eaten.food.max() >= len(ingredients):
+                    return None
+                if len(definedIn) != len(ingredients) or \
+                        len(mealFiles) != len(eaten):
+                    return None
+        except (OSError, ValueError, KeyError, TypeError, IndexError,
+                zipfile.BadZipFile):
+            return None
+        self.ingredients = ingredients
+        self._derived.clear()
+        self.eaten = eaten
+        self._definedIn = definedIn
+        self._mealFiles = mealFiles
+        return checkpoints
+
+    def _saveCache(self, path, checkpoints):
+        """Write the tables to a compiled cache, replacing it atomically.
+
+        Failure to write the cache (e.g. a read-only directory) is not an
+        error, it just means the next load will parse the files again.
+        """
+        table = self.ingredients
+        meta = {"version": CACHE_VERSION, "files": checkpoints}
+        try:
+            file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                    prefix=".fatcache", delete=False)
+        except OSError:
+            return
+        try:
+            with file:
+                np.savez(file,
+                    meta=np.array(json.dumps(meta)),
+                    ingred_name=np.array(table.names, dtype=str),
+                    ingred_unit=np.array(table.units, dtype=str),
+                    ingred_nutrients=table.nutrients,
+                    contents_ptr=table.contentPtr,
+                    contents_id=table.contentIds,
+                    contents_amt=table.contentAmts,
+                    contents_raw_amt=table.rawAmts,
+                    ingred_makes=table.makes,
+                    ingred_file=np.array(self._definedIn, dtype=np.intp),
+                    eaten_time=self.eaten.time,
+                    eaten_food=self.eaten.food,
+                    eaten_amt=self.eaten.amt,
+                    eaten_nutrients=self.eaten.nutrients,
+                    eaten_file=self._mealFiles)
+            os.replace(file.name, path)
+        except OSError:
+            os.unlink(file.name)
 
     def filteredRange(self, begin, end):
         """Get a FoodDB view that contains meals from the speficied timespan.
+
+        The view shares the ingredient table and meal log storage of this
+        FoodDB, so it costs a binary search regardless of the size of the log.
+        Views of views only ever contain meals from both intervals.
         
         Parameters
         ==========
@@ -253,14 +1741,14 @@ class FoodDB:
         end : datetime
             end of interval
         """
-        result = type(self)()
-        keys = [x.time for x in self.eaten]
-        first = bisect(keys, begin.timestamp())
-        after = bisect(keys, end.timestamp())
-        result.ingredients = self.ingredients
-        result.eaten = self.eaten[first:after]
-        result.begin = begin
-        result.end = end
+        with self.profiler.phase("filter"):
+            result = copy.copy(self)
+            result.eaten = self.eaten.timeRange(begin.timestamp(),
+                                                end.timestamp())
+            result.begin = begin
+            result.end = end
+            result._root = self._root or self
+        self.profiler.count("range queries")
         return result
 
     def totalStats(self):
@@ -283,27 +1771,17 @@ class FoodDB:
         protein_g
             Grams of protein
         """
-        totCal = 0
-        totCarb = 0
-        totFat = 0
-        totProt = 0
-        for meal in self.eaten:
-            totCal += meal.kcal
-            totCarb += meal.carbs
-            totFat += meal.fat
-            totProt += meal.protein
+        return self._statsFromSums(self.eaten.nutrients.sum(axis=0))
+
+    @staticmethod
+    def _statsFromSums(sums):
+        """TotalStats for the summed kcal, carbs, fat and protein of meals."""
+        totCal, totCarb, totFat, totProt = sums.tolist()
         totCarbCal = totCarb * 4
         totFatCal = totFat * 9
         totProtCal = totProt * 4
         totMacroCal = sum((totCarbCal, totFatCal, totProtCal))
-        return namedtuple("TotalStats",[
-            "kcal",
-            "carb_pct",
-            "fat_pct",
-            "protein_pct",
-            "carb_g",
-            "fat_g",
-            "protein_g"])(
+        return TotalStats(
             totCal,
             100 * totCarbCal / totMacroCal,
             100 * totFatCal / totMacroCal,
@@ -336,149 +1814,1379 @@ class FoodDB:
         deltaDays = (self.end - self.begin).total_seconds() / (3600*24)
         deltaDays = max(1, deltaDays) #daily stats nonsensical <1 day, avoid /0
         total = self.totalStats()
-        return namedtuple("MeanDailyStats",[
-            "kcal",
-            "carb_pct",
-            "fat_pct",
-            "protein_pct",
-            "carb_g",
-            "fat_g",
-            "protein_g"])(
+        return MeanDailyStats(
             total.kcal / deltaDays,
             *total[1:4],
             total.carb_g / deltaDays,
             total.fat_g / deltaDays,
             total.protein_g / deltaDays)
 
-    def blameMeals(self):
-        def mealCGen():
-            for meal in self.eaten:
-                vec = np.array((meal.kcal, meal.carbs, meal.fat, meal.protein))
-                yield (meal.name, vec)
-        return self._blameTally(mealCGen)
-
-    def blameIngredients(self):
-        def recurseCGen(ingredSpec):
-            ingred = self.ingredients[ingredSpec.name]
-            if len(ingred.contents) == 0:
-                vec = np.array((ingred.kcal, ingred.carbs, ingred.fat, ingred.protein))
-                vec = vec * ingredSpec.amt
-                yield (ingred.name, vec)
-            else:
-                for child in ingred.contents:
-                    yield from recurseCGen(child)
-        def ingredCGen():
-            for meal in self.eaten:
-                yield from recurseCGen(Ingredient.Sub(meal.name, meal.amt))
-        return self._blameTally(ingredCGen)
-
-    def _blameTally(self, culpritGen):
-        """Find the critical meals/ingredients."""
-        sources = defaultdict(lambda: np.zeros(4))
-        totals = np.zeros(4)
-        for culprit, vec in culpritGen():
-            sources[culprit] += vec
-            totals += vec
+    def _eatenByFood(self):
+        """Totals of each food eaten, in the order they were first eaten.
+
+        Returns
+        =======
+        foods : ndarray
+            ids of the foods eaten
+        amounts : ndarray
+            total amount eaten of each food
+        sums : ndarray
+            total kcal, carbs, fat and protein of each food, one row each
+        """
+        nfoods = len(self.ingredients)
+        foods = self.eaten.foodsByFirstAppearance()
+        amounts = np.bincount(self.eaten.food, weights=self.eaten.amt,
+                              minlength=nfoods)
+        sums = np.column_stack([np.bincount(self.eaten.food,
+                weights=self.eaten.nutrients[:, k], minlength=nfoods)
+                for k in range(4)])
+        return foods, amounts[foods], sums[foods].reshape(-1, 4)
+
+    def blameMeals(self, top=None):
+        foods, _, sums = self._eatenByFood()
+        return self._blameTally([self.ingredients.names[i] for i in foods],
+                                sums, top)
+
+    def blameIngredients(self, top=None):
+        base = self._baseIngredients()
+        nfoods = len(self.ingredients)
+        # Sparse matrix-vector product of the eaten foods' rows with the
+        # amounts eaten, keeping track of the order base ingredients appear.
+        foods, amounts, _ = self._eatenByFood()
+        starts = base.indptr[foods]
+        lengths = base.indptr[foods + 1] - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+                np.arange(lengths.sum())
+        leaves = base.indices[entries]
+        leafAmounts = np.bincount(leaves, minlength=nfoods,
+                weights=base.data[entries] * np.repeat(amounts, lengths))
+        ids, first = np.unique(leaves, return_index=True)
+        ids = ids[np.argsort(first, kind="stable")]
+        return self._blameTally([self.ingredients.names[i] for i in ids],
+                leafAmounts[ids, None] * self._foodNutrients()[ids], top)
+
+    def windowedBlame(self, days, top=5):
+        """Blame meals and ingredients separately for consecutive windows.
+
+        The windows are the given number of days long, starting at midnight
+        on the first day of the interval.  Each gets the leaderboards that
+        blameMeals and blameIngredients would give for its meals, but they
+        are all computed together in one pass over the meal log.
+
+        Returns
+        =======
+        A list of (begin, end, meals, ingredients) for each window, where
+        meals and ingredients are Culprits with the top culprits for each
+        nutrient.
+        """
+        if not 0 < days < float("inf"):
+            raise ValueError("window must be a positive number of days")
+        step = timedelta(days=days)
+        bounds = []
+        cursor = zeroHourDatetime(self.begin)
+        while cursor < self.end:
+            bounds.append(cursor)
+            cursor += step
+        bounds.append(cursor)
+        edges = np.searchsorted(self.eaten.time,
+                                [b.timestamp() for b in bounds], side="right")
+        eaten = self.eaten[edges[0]:edges[-1]]
+        nfoods = len(eaten.names)
+        windows = np.repeat(np.arange(len(bounds) - 1), np.diff(edges))
+        # Total each food per window.  Windows are consecutive in the log, so
+        # ordering the (window, food) pairs by first appearance groups them
+        # by window, and within a window orders them as blameMeals does.
+        pairs, first, inverse = np.unique(windows * nfoods + eaten.food,
+                return_index=True, return_inverse=True)
+        order = np.argsort(first, kind="stable")
+        pairs = pairs[order]
+        mealSums = np.column_stack([np.bincount(inverse,
+                weights=eaten.nutrients[:, k], minlength=len(pairs))
+                for k in range(4)])[order]
+        amounts = np.bincount(inverse, weights=eaten.amt,
+                              minlength=len(pairs))[order]
+        # Expand each pair into base ingredients, as blameIngredients does
+        base = self._baseIngredients()
+        foods = pairs % nfoods
+        starts = base.indptr[foods]
+        lengths = base.indptr[foods + 1] - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+                np.arange(lengths.sum())
+        leaves, first, inverse = np.unique(
+                np.repeat(pairs // nfoods, lengths) * nfoods +
+                base.indices[entries], return_index=True, return_inverse=True)
+        leafAmounts = np.bincount(inverse, minlength=len(leaves),
+                weights=base.data[entries] * np.repeat(amounts, lengths))
+        order = np.argsort(first, kind="stable")
+        leaves = leaves[order]
+        leafSums = leafAmounts[order, None] * \
+                self._foodNutrients()[leaves % nfoods]
+        names = np.array(eaten.names, dtype=object)
+        mealNames = names[foods]
+        leafNames = names[leaves % nfoods]
+        mealEdges = np.searchsorted(pairs // nfoods, np.arange(len(bounds)))
+        leafEdges = np.searchsorted(leaves // nfoods, np.arange(len(bounds)))
+        result = []
+        for i in range(len(bounds) - 1):
+            meals = slice(mealEdges[i], mealEdges[i + 1])
+            ingreds = slice(leafEdges[i], leafEdges[i + 1])
+            result.append((bounds[i], bounds[i + 1],
+                self._blameTally(mealNames[meals], mealSums[meals], top),
+                self._blameTally(leafNames[ingreds], leafSums[ingreds], top)))
+        return result
+
+    @staticmethod
+    def _topCulprits(culprits, percents, top):
+        """The first top entries of the full leaderboard, without sorting it.
+
+        Only the culprits with at least the top-th greatest percentage are
+        sorted, and ties keep their order, as in a full stable sort.
+        """
+        # A nutrient that nothing contained is all NaN, and stays in order
+        key = np.where(np.isnan(percents), -np.inf, percents)
+        candidates = np.arange(len(key))
+        if len(key) > top:
+            threshold = np.partition(key, len(key) - top)[len(key) - top]
+            candidates = np.flatnonzero(key >= threshold)
+        best = candidates[np.argsort(-key[candidates], kind="stable")[:top]]
+        return list(zip((culprits[i] for i in best.tolist()),
+                        percents[best].tolist()))
+
+    def _blameTally(self, culprits, sums, top=None):
+        """Find the critical meals/ingredients.
+
+        Parameters
+        ==========
+        culprits : list of str
+            names of the meals/ingredients
+        sums : ndarray
+            total kcal, carbs, fat and protein for each culprit, one row each
+        top : int or None
+            only find this many of the greatest culprits for each nutrient
+        """
         #convert to percent
-        sources = { k: v/totals * 100 for k,v in sources.items() }
+        percents = (sums / sums.sum(axis=0) * 100).T
         #Make leaderboards
-        kcalSort = sorted( ((k,v[0]) for k,v in sources.items()), key=lambda x: -x[1])
-        carbSort = sorted( ((k,v[1]) for k,v in sources.items()), key=lambda x: -x[1])
-        fatSort = sorted( ((k,v[2]) for k,v in sources.items()), key=lambda x: -x[1])
-        proteinSort = sorted( ((k,v[3]) for k,v in sources.items()), key=lambda x: -x[1])
-        return namedtuple("Culprits",["kcal", "carbs", "fat", "protein"])(
+        if top is None:
+            leaderboards = (sorted(zip(culprits, p), key=lambda x: -x[1])
+                            for p in percents.tolist())
+        else:
+            leaderboards = (self._topCulprits(culprits, p, top)
+                            for p in percents)
+        kcalSort, carbSort, fatSort, proteinSort = leaderboards
+        return Culprits(
                 kcalSort,
                 carbSort,
                 fatSort,
                 proteinSort)
 
-def doBlame(db):
+
+class FoodStream(FoodDB):
+    """A FoodDB whose meals are streamed from the files rather than loaded.
+
+    Loading checks the files and reads their ingredient tables, but only
+    notes the earliest meal and whether each file's meals are in time order.
+    Reports then read the meals again, dropping those outside the interval
+    as they are parsed, so memory use doesn't grow with the length of the
+    log.  A file whose meals are out of order is sorted with externalSort.
+    Only totalStats, meanDailyStats and streamTimeSeries look at the meals.
+    """
+
+    def __init__(self, filenames=[], runSize=100000, profiler=None):
+        """Load a FoodStream from fatscript files.
+
+        Parameters
+        ==========
+        filenames : list of str
+            fatscript files, read in order
+        runSize : int
+            Number of meals to sort in memory at once for files whose meals
+            are out of order.
+        profiler : Profiler or None
+            Record the time spent loading and reporting in this Profiler.
+        """
+        self.filenames = list(filenames)
+        self.runSize = runSize
+        self.profiler = profiler or nullProfiler
+        self.library = None
+        self._clear()
+        self._ordered = []
+        first = float("inf")
+        for fn in self.filenames:
+            self._lastMeal = -float("inf")
+            self._firstMeal = float("inf")
+            self._inOrder = True
+            with open(fn) as file:
+                self._integrateLines(fn, file)
+            self._ordered.append(self._inOrder)
+            first = min(first, self._firstMeal)
+        if first < float("inf"):
+            self.begin = datetime.fromtimestamp(first)
+        else:
+            self.begin = datetime.fromtimestamp(0)
+        self.end = datetime.now()
+        self._interval = (-float("inf"), float("inf"))
+
+    def _accumEat(self, parsed):
+        if parsed.item not in self.ingredients:
+            raise ValueError("Unknown food: \"{}\"".format(parsed.item))
+        self._inOrder = self._inOrder and parsed.time >= self._lastMeal
+        self._lastMeal = parsed.time
+        self._firstMeal = min(self._firstMeal, parsed.time)
+
+    def meals(self):
+        """Stream the meals in the interval.
+
+        Returns
+        =======
+        Iterator of (time, food id, amt) tuples in time order.  Meals with
+        equal times come in file order, as in FoodDB.eaten.
+        """
+        begin, end = self._interval
+        streams = []
+        for fn, ordered in zip(self.filenames, self._ordered):
+            meals = fileMeals(fn, self.ingredients.ids, begin, end)
+            if not ordered:
+                self.profiler.count("external sorts")
+                meals = externalSort(meals, self.runSize)
+            streams.append(meals)
+        return heapq.merge(*streams, key=lambda meal: meal[0])
+
+    def filteredRange(self, begin, end):
+        """Get a FoodStream view that only streams meals from the timespan.
+
+        Parameters
+        ==========
+        begin : datetime
+            start of interval
+        end : datetime
+            end of interval
+        """
+        result = super().filteredRange(begin, end)
+        result._interval = (max(self._interval[0], begin.timestamp()),
+                            min(self._interval[1], end.timestamp()))
+        return result
+
+    def mealChunks(self, size=65536):
+        """Stream the meals in the interval as arrays of up to size meals.
+
+        Returns
+        =======
+        Iterator of (time, nutrients) pairs of ndarrays, like the columns of
+        consecutive slices of FoodDB.eaten.
+        """
+        foodNutrients = self._foodNutrients()
+        meals = self.meals()
+        while True:
+            chunk = np.array(list(itertools.islice(meals, size)),
+                             dtype=_mealRecord)
+            if len(chunk) == 0:
+                return
+            self.profiler.count("meals streamed", len(chunk))
+            yield (chunk["time"],
+                   chunk["amt"][:, None] * foodNutrients[chunk["food"]])
+
+    def totalStats(self):
+        """Calculate the total kilocalories and macro ratios, like FoodDB."""
+        sums = np.zeros(4)
+        for _, nutrients in self.mealChunks():
+            sums += nutrients.sum(axis=0)
+        return self._statsFromSums(sums)
+
+
+DATABASE_VERSION = 1
+SQLITE_HEADER = b"SQLite format 3\0"
+
+_databaseSchema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE ingredients (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    unit TEXT NOT NULL,
+    kcal REAL NOT NULL,
+    carbs REAL NOT NULL,
+    fat REAL NOT NULL,
+    protein REAL NOT NULL);
+CREATE TABLE components (
+    food INTEGER NOT NULL REFERENCES ingredients (id),
+    position INTEGER NOT NULL,
+    component INTEGER NOT NULL REFERENCES ingredients (id),
+    amt REAL NOT NULL,
+    PRIMARY KEY (food, position));
+CREATE TABLE meals (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    food INTEGER NOT NULL REFERENCES ingredients (id),
+    amt REAL NOT NULL,
+    kcal REAL NOT NULL,
+    carbs REAL NOT NULL,
+    fat REAL NOT NULL,
+    protein REAL NOT NULL);
+CREATE INDEX meals_time ON meals (time);
+CREATE INDEX meals_food ON meals (food, time);
+"""
+
+def isDatabase(fn):
+    """Whether a file is a SQLite database rather than fatscript."""
+    try:
+        with open(fn, "rb") as file:
+            return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except OSError:
+        return False
+
+def importDatabase(db, path):
+    """Write a FoodDB to a SQLite database that SQLiteFoodDB can open.
+
+    Foods have the ids of their rows in the ingredients table, with their
+    kcal, carbs, fat and protein per unit, and the foods in a recipe are its
+    rows in the components table, in order.  Meals are stored in time order,
+    with their kcal, carbs, fat and protein, and indexed by time and by food.
+    The database is built beside path and then replaces it.
+    """
+    table = db.ingredients
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".fatimport")
+    os.close(fd)
+    try:
+        with contextlib.closing(sqlite3.connect(tmp)) as connection:
+            connection.executescript(_databaseSchema)
+            with connection:
+                connection.execute("INSERT INTO meta VALUES ('version', ?)",
+                                   (str(DATABASE_VERSION),))
+                connection.executemany(
+                        "INSERT INTO ingredients VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        ((food, name, unit, *nutrients) for food, name, unit,
+                         nutrients in zip(itertools.count(), table.names,
+                                          table.units,
+                                          table.nutrients.tolist())))
+                ptr = table.contentPtr.tolist()
+                connection.executemany(
+                        "INSERT INTO components VALUES (?, ?, ?, ?)",
+                        ((food, j - ptr[food], component, amt)
+                         for food in range(len(table))
+                         for j, component, amt in zip(
+                                range(ptr[food], ptr[food + 1]),
+                                table.contentIds[ptr[food]:ptr[food + 1]]
+                                .tolist(),
+                                table.contentAmts[ptr[food]:ptr[food + 1]]
+                                .tolist())))
+                eaten = db.eaten
+                connection.executemany(
+                        "INSERT INTO meals VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        ((i, *meal) for i, meal in enumerate(zip(
+                                eaten.time.tolist(), eaten.food.tolist(),
+                                eaten.amt.tolist(), *eaten.nutrients.T.tolist()))))
+            connection.execute("ANALYZE")
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class SQLiteFoodDB(FoodDB):
+    """A FoodDB kept in a SQLite database written by importDatabase.
+
+    The ingredient table is read when the database is opened, but the meals
+    stay in the database.  totalStats and blame are SQL aggregates over the
+    meals of the interval, found through the index on their time, and give
+    the same results as a FoodDB loaded from the fatscript, down to the last
+    bit unless SQLite's sums are more precise (from SQLite 3.43).  Other
+    reports read the meals of the interval into eaten the first time they
+    use it.
+    """
+
+    def __init__(self, path, profiler=None):
+        """Open a SQLiteFoodDB.
+
+        Parameters
+        ==========
+        path : str
+            the database
+        profiler : Profiler or None
+            Record the time spent loading and reporting in this Profiler.
+        """
+        self.path = path
+        self.jobs = 1
+        self.profiler = profiler or nullProfiler
+        self.library = None
+        self._clear()
+        with self.profiler.phase("read database"):
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            try:
+                version = self._connection.execute(
+                        "SELECT value FROM meta WHERE key = 'version'"
+                        ).fetchone()
+                if version is None or version[0] != str(DATABASE_VERSION):
+                    raise FatscriptError("ERROR {}: not a fat.py database of "
+                            "version {}".format(path, DATABASE_VERSION))
+                foods = self._connection.execute(
+                        "SELECT name, unit, kcal, carbs, fat, protein "
+                        "FROM ingredients ORDER BY id").fetchall()
+                components = self._connection.execute(
+                        "SELECT food, component, amt FROM components "
+                        "ORDER BY food, position").fetchall()
+                first, = self._connection.execute(
+                        "SELECT min(time) FROM meals").fetchone()
+            except sqlite3.DatabaseError as e:
+                raise FatscriptError("ERROR {}: {}".format(path, e))
+        counts = np.bincount([food for food, _, _ in components],
+                             minlength=len(foods))
+        self.ingredients = IngredientTable.fromArrays(
+                [food[0] for food in foods], [food[1] for food in foods],
+                [food[2:] for food in foods],
+                np.concatenate(([0], np.cumsum(counts))),
+                [component for _, component, _ in components],
+                [amt for _, _, amt in components])
+        if first is not None:
+            self.begin = datetime.fromtimestamp(first)
+        else:
+            self.begin = datetime.fromtimestamp(0)
+        self.end = datetime.now()
+        self._interval = (-float("inf"), float("inf"))
+        self._eaten = None
+
+    @property
+    def eaten(self):
+        """The meals of the interval, read from the database on first use."""
+        if self._eaten is None:
+            with self.profiler.phase("query"):
+                meals = self._query("SELECT time, food, amt, kcal, carbs, fat, "
+                                    "protein FROM meals WHERE {} ORDER BY time, id")
+                rows = np.array(meals, dtype=float).reshape(-1, 7)
+            self._eaten = MealLog(rows[:, 0], rows[:, 1].astype(np.intp),
+                                  rows[:, 2], rows[:, 3:],
+                                  self.ingredients.names)
+        return self._eaten
+
+    @eaten.setter
+    def eaten(self, eaten):
+        # Only FoodDB._clear sets it, before the database is open
+        self._eaten = eaten
+
+    def _query(self, sql):
+        """Run sql, formatted with a condition selecting meals in the interval."""
+        begin, end = self._interval
+        return self._connection.execute(sql.format("time > ? AND time <= ?"),
+                                        (begin, end)).fetchall()
+
+    def filteredRange(self, begin, end):
+        """Get a SQLiteFoodDB view that only looks at meals from the timespan.
+
+        Parameters
+        ==========
+        begin : datetime
+            start of interval
+        end : datetime
+            end of interval
+        """
+        with self.profiler.phase("filter"):
+            result = copy.copy(self)
+            result._interval = (max(self._interval[0], begin.timestamp()),
+                                min(self._interval[1], end.timestamp()))
+            result._eaten = None
+            result.begin = begin
+            result.end = end
+        self.profiler.count("range queries")
+        return result
+
+    def totalStats(self):
+        """Calculate the total kilocalories and macro ratios, like FoodDB."""
+        with self.profiler.phase("query"):
+            sums = self._query("SELECT total(kcal), total(carbs), total(fat), "
+                               "total(protein) FROM meals WHERE {}")
+        return self._statsFromSums(np.array(sums[0]))
+
+    def redefine(self, line):
+        """Not supported: the meals' nutrients are stored in the database."""
+        raise ValueError("A database can't be redefined, import it again")
+
+    def _eatenByFood(self):
+        with self.profiler.phase("query"):
+            # Meal ids are in time order, so the least is the first eaten
+            rows = self._query("SELECT food, min(id) AS first, total(amt), "
+                    "total(kcal), total(carbs), total(fat), total(protein) "
+                    "FROM meals WHERE {} GROUP BY food ORDER BY first")
+        rows = np.array(rows, dtype=float).reshape(-1, 7)
+        return rows[:, 0].astype(np.intp), rows[:, 2], rows[:, 3:]
+
+def doBlame(db, out=None, top=5):
     for mode, fun in [("Ingredients", db.blameIngredients), ("Meals", db.blameMeals)]:
-        result = fun()
-        print("{}:".format(mode))
-        for nutrient, leaderboard in result._asdict().items():
-            print("  {}".format(nutrient))
-            for culprit, percent in leaderboard[:5]:
-                print("    {:25} {:4.1f}%".format(culprit, percent))
-
-def printStatsObject(stats):
-    print("Calories {:5.0f}".format(stats.kcal))
-    print("Carbs    {:7.1f} g  ({:4.1f}%)".format(stats.carb_g, stats.carb_pct))
-    print("Fat      {:7.1f} g  ({:4.1f}%)".format(stats.fat_g, stats.fat_pct))
-    print("Protein  {:7.1f} g  ({:4.1f}%)".format(stats.protein_g, stats.protein_pct))
-
-def doSummary(db):
-    print("Daily Average".center(25))
-    printStatsObject(db.meanDailyStats())
+        with db.profiler.phase("aggregate"):
+            result = fun(top)
+        with db.profiler.phase("format"):
+            print("{}:".format(mode), file=out)
+            for nutrient, leaderboard in result._asdict().items():
+                print("  {}".format(nutrient), file=out)
+                for culprit, percent in leaderboard:
+                    print("    {:25} {:4.1f}%".format(culprit, percent), file=out)
+
+def doWindowedBlame(db, days, out=None, top=5):
+    """Print the top culprits of every window of some number of days."""
+    with db.profiler.phase("aggregate"):
+        windows = db.windowedBlame(days, top)
+    with db.profiler.phase("format"):
+        for begin, end, meals, ingredients in windows:
+            if len(meals.kcal) == 0:
+                continue
+            print("{} to {}:".format(begin.date(), end.date()), file=out)
+            for mode, culprits in [("Ingredients", ingredients), ("Meals", meals)]:
+                for nutrient, leaderboard in culprits._asdict().items():
+                    print("  {:12} {:8} {}".format(mode, nutrient, ", ".join(
+                          "{} {:.1f}%".format(culprit, percent)
+                          for culprit, percent in leaderboard)), file=out)
+                    mode = ""
+
+def printStatsObject(stats, out=None):
+    print("Calories {:5.0f}".format(stats.kcal), file=out)
+    print("Carbs    {:7.1f} g  ({:4.1f}%)".format(stats.carb_g, stats.carb_pct), file=out)
+    print("Fat      {:7.1f} g  ({:4.1f}%)".format(stats.fat_g, stats.fat_pct), file=out)
+    print("Protein  {:7.1f} g  ({:4.1f}%)".format(stats.protein_g, stats.protein_pct), file=out)
+
+def doSummary(db, out=None):
+    with db.profiler.phase("aggregate"):
+        stats = db.meanDailyStats()
+    with db.profiler.phase("format"):
+        print("Daily Average".center(25), file=out)
+        printStatsObject(stats, out)
 
 def zeroHourDatetime(dt):
     """Return a datetime corresponding to 00:00:00 on the same day as dt."""
     return dt.replace(hour=0, minute=0, second=0, microsecond=0)
 
-def doToday(db):
+def doToday(db, out=None):
     """Print today's kcal total and macro ratios."""
     end = datetime.now()
     begin = zeroHourDatetime(end)
     filtered = db.filteredRange(begin, end)
-    print("Eaten:")
-    print(filtered.formatEaten())
-    print("")
-    print("Total Today".center(25))
-    printStatsObject(filtered.totalStats())
-
-def makeSsvLine(db, timestamp):
-    stats = db.meanDailyStats()
-    return " ".join(str(x) for x in (
-            timestamp,
-            stats.kcal,
-            stats.carb_pct,
-            stats.fat_pct,
-            stats.protein_pct,
-            stats.carb_g,
-            stats.fat_g,
-            stats.protein_g))
-
-def doTimeSeries(db, avg):
-    print("time kcal percent_carbs percent_fat percent_protein carbs_g fat_g protein_g")
-    cursor = zeroHourDatetime(db.begin)
-    end = db.end
+    with db.profiler.phase("format"):
+        print("Eaten:", file=out)
+        writeEaten(filtered.eaten, out)
+        print("", file=out)
+    with db.profiler.phase("aggregate"):
+        stats = filtered.totalStats()
+    with db.profiler.phase("format"):
+        print("Total Today".center(25), file=out)
+        printStatsObject(stats, out)
+
+class TimestampFormatter:
+    """Format epoch timestamps as str(datetime.fromtimestamp(t)) does.
+
+    The local time at the start of each day, counted in UTC, is looked up
+    once, and the whole seconds since then are added to it as text, which is
+    much quicker than building a datetime for every meal.  Days in which the
+    UTC offset changes, and fractional seconds, go through datetime.
+    """
+
+    def __init__(self):
+        self._days = {}
+
+    def __call__(self, t):
+        second = int(t)
+        if second != t:
+            return str(datetime.fromtimestamp(t))
+        day = second - second % 86400
+        cached = self._days.get(day)
+        if cached is None:
+            start = datetime.fromtimestamp(day)
+            cached = False
+            if datetime.fromtimestamp(day + 86399) - start == \
+                    timedelta(seconds=86399):
+                cached = (start.hour * 3600 + start.minute * 60 + start.second,
+                          str(start.date()),
+                          str(start.date() + timedelta(days=1)))
+            self._days[day] = cached
+        if cached is False:
+            return str(datetime.fromtimestamp(t))
+        offset, date, nextDate = cached
+        local = offset + second - day
+        if local >= 86400:
+            date = nextDate
+            local -= 86400
+        return "{} {:02d}:{:02d}:{:02d}".format(date, local // 3600,
+                                                local // 60 % 60, local % 60)
+
+def writeLines(lines, out=None, chunk=4096):
+    """Write lines, each ending in a newline, a chunk of lines at a time.
+
+    As print does for "\\n".join(lines), writes a single newline if there
+    are no lines.
+    """
+    out = out or sys.stdout
+    buffer = []
+    written = False
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= chunk:
+            out.write("".join(buffer))
+            buffer.clear()
+            written = True
+    if buffer or not written:
+        out.write("".join(buffer) or "\n")
+
+def writeIngredients(table, out=None):
+    """Write the lines of FoodDB.formatIngredients, sorted by name."""
+    writeLines(("  {}\n".format(table[name])
+                for name in sorted(table.names)), out)
+
+def _mealLines(eaten, chunk=4096):
+    formatTime = TimestampFormatter()
+    names = eaten.names
+    for start in range(0, len(eaten), chunk):
+        part = eaten[start:start + chunk]
+        kcal, carbs, fat, protein = part.nutrients.T.tolist()
+        for row in zip(part.time.tolist(), part.food.tolist(),
+                       part.amt.tolist(), kcal, carbs, fat, protein):
+            # The repr of a Meal after Meal.__str__ has rounded it
+            yield "  Meal(time={!r}, name={!r}, amt={!r}, kcal={!r}, " \
+                    "carbs={!r}, fat={!r}, protein={!r})\n".format(
+                    formatTime(row[0]), names[row[1]], row[2],
+                    round(row[3]), round(row[4], 1), round(row[5], 1),
+                    round(row[6], 1))
+
+def writeEaten(eaten, out=None):
+    """Write the lines of FoodDB.formatEaten for a MealLog as they are made."""
+    writeLines(_mealLines(eaten), out)
+
+def _tsvField(value):
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t") \
+                .replace("\n", "\\n").replace("\r", "\\r")
+    return repr(value)
+
+def _tsvLines(header, rows):
+    yield "\t".join(header) + "\n"
+    for row in rows:
+        yield "\t".join(_tsvField(value) for value in row) + "\n"
+
+def _ingredientRows(table):
+    """Name, unit, kcal, carbs, fat, protein and contents of each food."""
+    ptr = table.contentPtr.tolist()
+    contentIds = table.contentIds.tolist()
+    contentAmts = table.contentAmts.tolist()
+    nutrients = table.nutrients.tolist()
+    for food in sorted(range(len(table)), key=table.names.__getitem__):
+        contents = [(table.names[c], a) for c, a in zip(
+                contentIds[ptr[food]:ptr[food + 1]],
+                contentAmts[ptr[food]:ptr[food + 1]])]
+        yield (table.names[food], table.units[food], *nutrients[food],
+               contents)
+
+def _mealRows(eaten, chunk=4096):
+    """Time, food name, amt, kcal, carbs, fat and protein of each meal."""
+    names = eaten.names
+    for start in range(0, len(eaten), chunk):
+        part = eaten[start:start + chunk]
+        for time, food, amt, nutrients in zip(part.time.tolist(),
+                part.food.tolist(), part.amt.tolist(),
+                part.nutrients.tolist()):
+            yield (time, names[food], amt, *nutrients)
+
+dumpFormats = ("text", "tsv", "jsonl")
+
+def doDump(db, out=None, format="text"):
+    """Print the ingredient table and meal log, streaming them out.
+
+    Parameters
+    ==========
+    format : str
+        "text" for the repr-like listing that FoodDB's str has always given;
+        "tsv" for three tab separated tables, each with a header line, and
+        separated by blank lines: the interval, the ingredients with their
+        contents as a JSON list of [name, amt], and the meals.  Numbers have
+        full precision, times are epoch timestamps, and tabs, newlines and
+        backslashes in names are escaped with backslashes.  Or "jsonl" for
+        one JSON object per line, the interval first, then an object for
+        each ingredient and for each meal, with a "type" field of
+        "interval", "ingredient" or "meal".
+    """
+    if format not in dumpFormats:
+        raise ValueError("Unknown dump format \"{}\"".format(format))
+    out = out or sys.stdout
+    with db.profiler.phase("format"):
+        if format == "text":
+            print("{} to {}".format(db.begin, db.end), file=out)
+            print("Ingredients:", file=out)
+            writeIngredients(db.ingredients, out)
+            print("Eaten:", file=out)
+            writeEaten(db.eaten, out)
+        elif format == "tsv":
+            writeLines(itertools.chain(
+                    _tsvLines(["begin", "end"], [(db.begin.timestamp(),
+                                                  db.end.timestamp())]),
+                    ["\n"],
+                    _tsvLines(["name", "unit", "kcal", "carbs", "fat",
+                               "protein", "contents"],
+                              ((*row[:-1], json.dumps(row[-1]))
+                               for row in _ingredientRows(db.ingredients))),
+                    ["\n"],
+                    _tsvLines(["time", "name", "amt", "kcal", "carbs", "fat",
+                               "protein"], _mealRows(db.eaten))), out)
+        else:
+            ingredientFields = ["name", "unit", "kcal", "carbs", "fat",
+                                "protein", "contents"]
+            mealFields = ["time", "name", "amt", "kcal", "carbs", "fat",
+                          "protein"]
+            writeLines(itertools.chain(
+                    [json.dumps({"type": "interval",
+                                 "begin": db.begin.timestamp(),
+                                 "end": db.end.timestamp()}) + "\n"],
+                    (json.dumps({"type": "ingredient",
+                                 **dict(zip(ingredientFields, row))}) + "\n"
+                     for row in _ingredientRows(db.ingredients)),
+                    (json.dumps({"type": "meal",
+                                 **dict(zip(mealFields, row))}) + "\n"
+                     for row in _mealRows(db.eaten))), out)
+
+def dayStarts(begin, end):
+    """Local midnights from the start of begin's day, up to end."""
     step = timedelta(days=1)
-    avg_td = timedelta(days=avg)
+    cursor = zeroHourDatetime(begin)
     while cursor < end:
-        window = db.filteredRange(cursor + step - avg_td, cursor + step)
-        print(makeSsvLine(window, cursor.timestamp()))
+        yield cursor
         cursor += step
 
-def main(injectArgs=None):
-    # Get args
-    args = docopt(__doc__, argv=injectArgs, version='0.2')
+def windowStats(time, nutrients, days, avg):
+    """Moving average daily statistics of meals for some days.
 
-    # Load files
-    db = FoodDB(args['<file>'])
+    Each day's window ends at the following local midnight and extends back
+    avg days.  Window sums are differences of cumulative nutrient sums, so the
+    cost is one pass over the meals plus one search per window boundary.
 
-    # Figure out the filtering dates
-    if args['--begin-interval']:
-        begin = cal.parseDT(args['--begin-interval'])[0]
+    Parameters
+    ==========
+    time, nutrients : ndarray
+        time sorted meal columns, as in MealLog, including every meal in the
+        days' windows
+    days : list of datetime
+        local midnights at the start of the days
+
+    Returns
+    =======
+    One row per day with the fields of FoodDB.meanDailyStats, as an ndarray.
+    """
+    step = timedelta(days=1)
+    avg_td = timedelta(days=avg)
+    bounds = np.searchsorted(time,
+            [[(d + step - avg_td).timestamp(), (d + step).timestamp()]
+             for d in days], side="right").reshape(-1, 2)
+    cumulative = np.zeros((len(time) + 1, 4))
+    np.cumsum(nutrients, axis=0, out=cumulative[1:])
+    totals = cumulative[bounds[:, 1]] - cumulative[bounds[:, 0]]
+    deltaDays = max(1, avg_td.total_seconds() / (3600*24))
+    macroCal = totals[:, 1:4] * (4, 9, 4)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        percents = 100 * macroCal / macroCal.sum(axis=1, keepdims=True)
+    return np.column_stack((totals[:, 0] / deltaDays, percents,
+                            totals[:, 1:4] / deltaDays))
+
+def timeSeries(db, avg):
+    """Moving average daily statistics for every day of db's interval.
+
+    Returns
+    =======
+    times : list of float
+        epoch timestamp of local midnight at the start of each day
+    stats : ndarray
+        one row per day with the fields of FoodDB.meanDailyStats, see
+        windowStats
+    """
+    days = list(dayStarts(db.begin, db.end))
+    times = [d.timestamp() for d in days]
+    return times, windowStats(db.eaten.time, db.eaten.nutrients, days, avg)
+
+def streamTimeSeries(db, avg, batch=4096):
+    """Moving average daily statistics for every day of a FoodStream.
+
+    The meals are read in chunks and kept only while they are inside the
+    window of a day that hasn't been computed yet, so memory use depends on
+    the length of the window, not of the log.
+
+    Returns
+    =======
+    Iterator of (timestamp, stats) pairs, one for each row of timeSeries.
+    """
+    step = timedelta(days=1)
+    avg_td = timedelta(days=avg)
+    chunks = db.mealChunks()
+    time = np.zeros(0)
+    nutrients = np.zeros((0, 4))
+    exhausted = False
+    days = dayStarts(db.begin, db.end)
+    day = next(days, None)
+    while day is not None:
+        # A day's window is complete once a later meal has been read
+        ready = []
+        while day is not None and len(ready) < batch and (exhausted or
+                (len(time) > 0 and time[-1] > (day + step).timestamp())):
+            ready.append(day)
+            day = next(days, None)
+        if len(ready) == 0:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+            else:
+                time = np.concatenate((time, chunk[0]))
+                nutrients = np.concatenate((nutrients, chunk[1]))
+            continue
+        stats = windowStats(time, nutrients, ready, avg)
+        yield from zip((d.timestamp() for d in ready), stats.tolist())
+        if day is not None:
+            expired = np.searchsorted(time, (day + step - avg_td).timestamp(),
+                                      side="right")
+            time = time[expired:]
+            nutrients = nutrients[expired:]
+
+def doTimeSeries(db, avg, out=None):
+    print("time kcal percent_carbs percent_fat percent_protein carbs_g fat_g protein_g",
+          file=out)
+    if isinstance(db, FoodStream):
+        # The rows are computed as they are printed
+        phase = "aggregate"
+        rows = streamTimeSeries(db, avg)
     else:
-        begin = db.begin
-    if args['--end-interval']:
-        end = cal.parseDT(args['--end-interval'])[0]
+        phase = "format"
+        with db.profiler.phase("aggregate"):
+            times, stats = timeSeries(db, avg)
+        rows = zip(times, stats.tolist())
+    with db.profiler.phase(phase):
+        for timestamp, row in rows:
+            print(" ".join(str(x) for x in (timestamp, *row)), file=out)
+            db.profiler.count("time series days")
+
+def timeSeriesBlocks(db, avg, size=4096):
+    """The time series as arrays of up to size rows.
+
+    Each row holds the timestamp and the statistics of one day, the columns
+    printed by doTimeSeries.
+    """
+    if isinstance(db, FoodStream):
+        rows = streamTimeSeries(db, avg)
+        while True:
+            block = [(t, *row) for t, row in itertools.islice(rows, size)]
+            if len(block) == 0:
+                return
+            yield np.array(block, dtype=float)
+    else:
+        times, stats = timeSeries(db, avg)
+        yield np.column_stack((times, stats)).reshape(-1, 8)
+
+def writeTimeSeries(db, avg, path):
+    """Write the time series to a binary file.
+
+    The columns of doTimeSeries are written as little-endian float64, which
+    holds every value exactly as printed.  A path ending in .npy gets a NumPy
+    array of shape (days, 8) that np.load can memory map, filled in through
+    a memory map itself; any other path gets the bare rows, 64 bytes a day,
+    as gnuplot reads with binary format="%8float64" endian=little.
+    """
+    with db.profiler.phase("aggregate"):
+        blocks = timeSeriesBlocks(db, avg)
+        if path.endswith(".npy"):
+            days = sum(1 for _ in dayStarts(db.begin, db.end))
+            if days == 0:
+                np.save(path, np.zeros((0, 8), dtype="<f8"))
+                return
+            out = np.lib.format.open_memmap(path, mode="w+", dtype="<f8",
+                                            shape=(days, 8))
+            row = 0
+            for block in blocks:
+                out[row:row + len(block)] = block
+                row += len(block)
+            out.flush()
+            del out
+        else:
+            with open(path, "wb") as out:
+                for block in blocks:
+                    out.write(block.astype("<f8").tobytes())
+
+KCAL_PER_KG = 7700
+"""Energy in a kilogram of body weight, mostly fat, in kilocalories."""
+
+def loadWeightLogs(filenames):
+    """Read the weigh-ins logged by weigh.py.
+
+    Each file has a "time weight_kg" header line, then one "time weight"
+    line per weigh-in.  The weigh-ins of all the files are merged.
+
+    Returns
+    =======
+    time, weight : ndarray
+        epoch timestamps and weights in kg, sorted by time
+    """
+    times = []
+    weights = []
+    for fn in filenames:
+        with open(fn) as f:
+            header = f.readline().split()
+            if header != ["time", "weight_kg"]:
+                raise FatscriptError(
+                        "ERROR {}: not a weigh.py log, its first line is "
+                        "\"{}\"".format(fn, " ".join(header)))
+            lines = f.readlines()
+        if len(lines) == 0:
+            continue
+        try:
+            log = np.loadtxt(lines, ndmin=2, usecols=(0, 1))
+        except ValueError as e:
+            raise FatscriptError("ERROR {}: {}".format(fn, e))
+        times.append(log[:, 0])
+        weights.append(log[:, 1])
+    time = np.concatenate([np.zeros(0)] + times)
+    order = np.argsort(time, kind="stable")
+    return time[order], np.concatenate([np.zeros(0)] + weights)[order]
+
+def trailingMean(time, values, at, days):
+    """Mean of the values timestamped within some days up to each time in at.
+
+    Like windowStats, the windows are differences of cumulative sums, found
+    with a binary search per window, so they can be long or overlap freely.
+    Windows without any values get NaN.
+    """
+    bounds = np.searchsorted(time, [at - days * 24 * 3600, at], side="right")
+    cumulative = np.zeros(len(values) + 1)
+    np.cumsum(values, out=cumulative[1:])
+    counts = bounds[1] - bounds[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (cumulative[bounds[1]] - cumulative[bounds[0]]) / counts
+
+def weightSeries(db, weightTime, weight, avg, smooth):
+    """Join daily intake with the weigh-ins of the same days.
+
+    Every day of db's interval is matched, as of its end, with the latest
+    weigh-in and the mean of the weigh-ins in the smooth days before.  The
+    change in that smoothed weight over the avg days before, in kcal per day,
+    is the implied energy balance, and the average intake less the balance
+    is the implied expenditure.
+
+    Parameters
+    ==========
+    weightTime, weight : ndarray
+        weigh-ins, as returned by loadWeightLogs
+    avg : float
+        days to average intake and energy balance over
+    smooth : float
+        days to average weight over
+
+    Returns
+    =======
+    times : list of float
+        epoch timestamp of local midnight at the start of each day
+    rows : ndarray
+        one row per day, with kcal, average kcal, weight, smoothed weight,
+        energy balance and expenditure
+    """
+    days = list(dayStarts(db.begin, db.end))
+    times = [d.timestamp() for d in days]
+    intake = windowStats(db.eaten.time, db.eaten.nutrients, days, 1)[:, 0]
+    average = windowStats(db.eaten.time, db.eaten.nutrients, days, avg)[:, 0]
+    ends = np.array([(d + timedelta(days=1)).timestamp() for d in days])
+    starts = np.array([(d + timedelta(days=1) - timedelta(days=avg))
+                       .timestamp() for d in days])
+    # Days before the first weigh-in get index -1, the NaN on the end
+    latest = np.searchsorted(weightTime, ends, side="right") - 1
+    asOf = np.append(weight, np.nan)[latest]
+    smoothed = trailingMean(weightTime, weight, ends, smooth)
+    before = trailingMean(weightTime, weight, starts, smooth)
+    balance = (smoothed - before) * KCAL_PER_KG / max(1, avg)
+    return times, np.column_stack((intake, average, asOf, smoothed, balance,
+                                   average - balance)).reshape(-1, 6)
+
+def doWeight(db, weightLogs, avg, smooth, out=None):
+    with db.profiler.phase("aggregate"):
+        weightTime, weight = loadWeightLogs(weightLogs)
+        db.profiler.count("weigh-ins", len(weight))
+        times, rows = weightSeries(db, weightTime, weight, avg, smooth)
+    with db.profiler.phase("format"):
+        print("time kcal kcal_avg weight_kg weight_smoothed_kg balance_kcal "
+              "expenditure_kcal", file=out)
+        for timestamp, row in zip(times, rows.tolist()):
+            print(" ".join(str(x) for x in (timestamp, *row)), file=out)
+
+def loadFoodDB(args, profiler=None, filenames=None):
+    """Load the FoodDB for the <file> arguments and caching options in args.
+
+    Parameters
+    ==========
+    filenames : list of str or None
+        Load these files instead of the <file> arguments.
+    """
+    if filenames is None:
+        filenames = args['<file>']
+    profiler = profiler or nullProfiler
+    databases = [fn for fn in filenames if isDatabase(fn)]
+    if len(databases) > 0:
+        if len(filenames) > 1:
+            raise FatscriptError("ERROR {}: a database can't be loaded with "
+                                 "other files".format(databases[0]))
+        with profiler.phase("load"):
+            return SQLiteFoodDB(databases[0], profiler)
+    if args['--clear-cache']:
+        try:
+            os.unlink(cachePath(filenames))
+        except FileNotFoundError:
+            pass
+    with profiler.phase("load"):
+        if args['--stream']:
+            return FoodStream(filenames, profiler=profiler)
+        return FoodDB(filenames, cache=not args['--no-cache'],
+                      jobs=int(args['--jobs']), profiler=profiler)
+
+def printProfile(profiler, args, out=None):
+    """Print a profile as a table, or as JSON if args has --profile-json."""
+    if args['--profile-json']:
+        print(json.dumps(profiler.asDict(), indent=2), file=out)
     else:
-        end = db.end
-    # Filter
-    db = db.filteredRange(begin, end)
+        print(profiler, file=out)
+
+def checkArgs(args):
+    """Exit with an error message if args hold an option value that's invalid.
+
+    This is done before loading anything, so that a bad option doesn't fail
+    part of the way through a report.
+    """
+    if args['--window'] is not None:
+        try:
+            window = float(args['--window'])
+        except ValueError:
+            window = float("nan")
+        if not 0 < window < float("inf"):
+            exit("ERROR --window must be a positive number of days, not "
+                 "\"{}\"".format(args['--window']))
+    if args['--format'] not in dumpFormats:
+        exit("ERROR unknown dump format \"{}\", use one of {}".format(
+                args['--format'], ", ".join(dumpFormats)))
 
-    # Do the thang
+def report(db, args, out=None):
+    """Print the report requested by args for the interval it selects."""
+    printReport(selectInterval(db, args), args, out)
+
+def selectInterval(db, args):
+    """The view of a FoodDB for the interval args select with -b and -e."""
+    # Figure out the filtering dates
+    with db.profiler.phase("parse dates"):
+        if args['--begin-interval']:
+            begin = parseDate(args['--begin-interval'])
+        else:
+            begin = db.begin
+        if args['--end-interval']:
+            end = parseDate(args['--end-interval'])
+        else:
+            end = db.end
+    return db.filteredRange(begin, end)
+
+def printReport(db, args, out=None):
+    """Print the report requested by args for all of a FoodDB."""
     if args['dump']:
-        print(db)
+        doDump(db, out, args['--format'])
+    elif args['blame'] and args['--window']:
+        doWindowedBlame(db, float(args['--window']), out)
     elif args['blame']:
-        doBlame(db)
+        doBlame(db, out)
     elif args['summary']:
-        doSummary(db)
+        doSummary(db, out)
     elif args['today']:
-        doToday(db)
+        doToday(db, out)
+    elif args['time_series'] and args['--binary']:
+        writeTimeSeries(db, float(args['--avg']), args['--binary'])
     elif args['time_series']:
-        doTimeSeries(db, float(args['--avg']))
+        doTimeSeries(db, float(args['--avg']), out)
+    elif args['weight']:
+        doWeight(db, args['--weights'], float(args['--avg']),
+                 float(args['--smooth']), out)
+
+
+reportCommands = ("summary", "today", "blame", "dump", "time_series")
+
+_sectionState = None
+
+def _reportSection(command):
+    """Make one report of doReports, in a worker thread or process."""
+    db, args = _sectionState
+    sectionArgs = dict(args, report=False)
+    sectionArgs.update((c, c == command) for c in reportCommands)
+    out = io.StringIO()
+    printReport(db, sectionArgs, out)
+    return out.getvalue()
+
+def doReports(db, args, out=None):
+    """Print each of the reports requested in args from one FoodDB.
+
+    The reports are made concurrently from the shared FoodDB, each in its own
+    thread, or with --jobs above 1, in that many forked processes, which
+    share it copy-on-write and format their reports in parallel too.  A
+    database is always reported on in threads, because a SQLite connection
+    can't be used across a fork.  Each report is printed as a section headed
+    by a "# <command>" line, in the order of reportCommands, and sections are
+    separated by two blank lines, as in doBatch.
+    """
+    global _sectionState
+    loadLazyModules()
+    commands = [c for c in reportCommands if args[c]]
+    jobs = int(args['--jobs'])
+    # The interval is the same for every section, so select it once, before
+    # starting any threads
+    db = selectInterval(db, args)
+    _sectionState = (db, args)
+    if jobs > 1 and not isinstance(db, SQLiteFoodDB):
+        pool = concurrent.futures.ProcessPoolExecutor(min(jobs, len(commands)),
+                mp_context=multiprocessing.get_context("fork"))
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(len(commands))
+    with pool:
+        sections = list(pool.map(_reportSection, commands))
+    for i, (command, text) in enumerate(zip(commands, sections)):
+        if i > 0:
+            print("\n", file=out)
+        print("# {}".format(command), file=out)
+        (out or sys.stdout).write(text)
+
+_batchState = None
+
+def _batchReport(fn):
+    """Report on one log of a batch, in a batchReports worker or not.
+
+    Returns
+    =======
+    The report as text, and the error message if loading failed, or None.
+    """
+    library, args, profiler = _batchState
+    out = io.StringIO()
+    try:
+        with profiler.phase("load"):
+            db = FoodDB([fn], profiler=profiler, library=library)
+        report(db, args, out)
+    except FatscriptError as e:
+        return out.getvalue(), str(e)
+    except OSError as e:
+        return out.getvalue(), "ERROR {}: {}".format(fn, e.strerror)
+    except UnicodeDecodeError as e:
+        return out.getvalue(), "ERROR {}: {}".format(fn, e)
+    return out.getvalue(), None
+
+def batchReports(library, filenames, args, jobs=1, profiler=None):
+    """Report on each of many logs loaded against one library.
+
+    With more than one job, the logs are loaded and reported on in forked
+    processes, which share the library's memory with this one copy-on-write
+    instead of each being sent a copy.
+
+    Parameters
+    ==========
+    library : FoodDB
+        foods that the logs eat, shared by all of them
+    filenames : list of str
+        the logs, each loaded into its own FoodDB and reported on separately
+    args : dict
+        the report to make, as for report
+    jobs : int
+        Number of processes to load and report with.
+    profiler : Profiler or None
+        Record the time spent loading and reporting in this Profiler, when
+        there is only one job.
+
+    Returns
+    =======
+    Iterator of what _batchReport returns for each log, in order.
+    """
+    global _batchState
+    library.ingredients.freeze()
+    if jobs > 1 and len(filenames) > 1:
+        _batchState = (library, args, nullProfiler)
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(jobs,
+                mp_context=context) as pool:
+            yield from pool.map(_batchReport, filenames)
+    else:
+        _batchState = (library, args, profiler or nullProfiler)
+        yield from map(_batchReport, filenames)
+
+def doBatch(args, profiler=None, out=None):
+    """Print the report requested by args for each <file> against <library>.
+
+    Each log's report is headed by a "# <file>" comment line, and reports are
+    separated by two blank lines, so that gnuplot can pick out each log's
+    time series with index.
+
+    Returns
+    =======
+    The exit status: 1 if any log failed to load, otherwise 0.
+    """
+    library = loadFoodDB(args, profiler, [args['<library>']])
+    status = 0
+    reports = batchReports(library, args['<file>'], args,
+                           int(args['--jobs']), profiler)
+    for i, (fn, (text, error)) in enumerate(zip(args['<file>'], reports)):
+        if i > 0:
+            print("\n", file=out)
+        print("# {}".format(fn), file=out)
+        (out or sys.stdout).write(text)
+        if error is not None:
+            print(error, file=sys.stderr)
+            status = 1
+    return status
+
+
+class FatServer(socketserver.ThreadingUnixStreamServer):
+    """Answer report queries over a Unix socket from a resident FoodDB.
+
+    Each request is one line of JSON, {"argv": [...]}, holding fat.py
+    arguments without the files, which are those the server was started with.
+    The response is a line of JSON, {"status": exit status, "stderr": text},
+    followed by the report exactly as fat.py would print it.  Files are
+    reloaded, through the compiled cache if enabled, when a request finds
+    that their size or modification time has changed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, args):
+        self.args = args
+        self.filenames = [os.path.abspath(fn) for fn in args['<file>']]
+        self._lock = threading.Lock()
+        self._stamps = self._fileStamps()
+        self._db = loadFoodDB(args)
+        args['--clear-cache'] = False
+        if os.path.exists(path):
+            # Take over the socket of a dead server, but not a live one
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    os.unlink(path)
+        super().__init__(path, FatRequestHandler)
+        os.chmod(path, 0o600)
+
+    def _fileStamps(self):
+        stamps = []
+        for fn in self.filenames:
+            st = os.stat(fn)
+            stamps.append((st.st_size, st.st_mtime_ns))
+        return stamps
+
+    def database(self):
+        """The current FoodDB, reloading it first if any file has changed."""
+        with self._lock:
+            stamps = self._fileStamps()
+            if stamps != self._stamps:
+                self._db = loadFoodDB(self.args)
+                self._stamps = stamps
+            return self._db
+
+    def server_close(self):
+        super().server_close()
+        os.unlink(self.server_address)
+
+
+class FatRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            # A probe for a live server, see FatServer.__init__
+            return
+        out = io.StringIO()
+        status = 0
+        stderr = ""
+        try:
+            request = json.loads(line)
+            args = docopt(__doc__, argv=request["argv"] + self.server.filenames)
+            checkArgs(args)
+            # The FoodDB's interval ends when it was loaded, but a report
+            # from fat.py runs up to now
+            db = copy.copy(self.server.database())
+            db.end = datetime.now()
+            profiler = None
+            if args['--profile'] or args['--profile-json']:
+                profiler = Profiler()
+                db.profiler = profiler
+            report(db, args, out)
+        except FatscriptError as e:
+            status, stderr = 1, "{}\n".format(e)
+        except SystemExit as e:
+            status, stderr = 1, "{}\n".format(e)
+        except Exception:
+            status, stderr = 1, traceback.format_exc()
+        else:
+            if profiler is not None:
+                profile = io.StringIO()
+                printProfile(profiler, args, profile)
+                stderr = profile.getvalue()
+        self.wfile.write(json.dumps({"status": status, "stderr": stderr}).encode())
+        self.wfile.write(b"\n")
+        self.wfile.write(out.getvalue().encode())
+
+def serve(path, args):
+    """Run a FatServer on the Unix socket path until interrupted."""
+    loadLazyModules()
+    with FatServer(path, args) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def query(path, args, out=None):
+    """Ask the FatServer on the Unix socket path for the report in args.
+
+    Returns
+    =======
+    The exit status of the report.
+    """
+    argv = []
+    for option in ('--begin-interval', '--end-interval'):
+        if args[option] is not None:
+            argv.append("{}={}".format(option, args[option]))
+    if args['time_series']:
+        argv.append("--avg={}".format(args['--avg']))
+    if args['blame'] and args['--window'] is not None:
+        argv.append("--window={}".format(args['--window']))
+    if args['dump']:
+        argv.append("--format={}".format(args['--format']))
+    argv.extend(o for o in ('--profile', '--profile-json') if args[o])
+    argv.extend(c for c in reportCommands if args[c])
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps({"argv": argv}).encode() + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile("rb") as response:
+            header = json.loads(response.readline())
+            body = response.read()
+    (out or sys.stdout).write(body.decode())
+    sys.stderr.write(header["stderr"])
+    return header["status"]
+
+def main(injectArgs=None):
+    # Get args
+    args = docopt(__doc__, argv=injectArgs, version='0.2')
+    checkArgs(args)
+
+    if args['query']:
+        try:
+            exit(query(args['<socket>'], args))
+        except OSError as e:
+            print("ERROR no fat.py server at {}: {}".format(
+                args['<socket>'], e.strerror), file=sys.stderr)
+            exit(1)
+    profiler = None
+    if args['--profile'] or args['--profile-json']:
+        profiler = Profiler()
+    try:
+        if args['serve']:
+            serve(args['<socket>'], args)
+        elif args['batch']:
+            exit(doBatch(args, profiler))
+        elif args['report']:
+            doReports(loadFoodDB(args, profiler), args)
+        elif args['import']:
+            db = loadFoodDB(args, profiler)
+            with db.profiler.phase("write database"):
+                importDatabase(db, args['<database>'])
+        else:
+            report(loadFoodDB(args, profiler), args)
+    except FatscriptError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    finally:
+        if profiler is not None:
+            printProfile(profiler, args, sys.stderr)
     
 if __name__ == "__main__":
     main()
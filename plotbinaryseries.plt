@@ -0,0 +1,45 @@
+#!/usr/bin/gnuplot
+# Copyright (C) 2016 Russell Haley
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Plots the output of fat.py --binary=fat.bin time_series, like
+# plottimeseries.plt does for the text output.
+
+datafile = "fat.bin"
+binfmt = 'binary format="%8float64" endian=little'
+ncols = 8
+titles = "time kcal percent_carbs percent_fat percent_protein carbs_g fat_g protein_g"
+
+set title "Eaten"
+set key noenhanced
+
+set xdata time
+set format x "%Y/%m/%d"
+
+set yrange [0:*]
+plot datafile @binfmt using 1:2 title word(titles, 2) with linespoints
+pause mouse
+
+plot \
+  for [i=3:ncols] \
+    datafile @binfmt using 1:(sum [col=i:ncols] column(col)) \
+      title word(titles, i) \
+      with filledcurves x1
+
+pause mouse
+
+plot for [i=3:ncols] datafile @binfmt using 1:i title word(titles, i) with linespoints
+
+pause mouse close
@@ -17,9 +17,8 @@
 from __future__ import absolute_import, division, print_function
 
 import sys
-sys.path.append('/usr/local/lib64/python2.7/site-packages')
-import xwiimote
 import select
+import struct
 import time
 import os
 import argparse
@@ -29,8 +28,23 @@ from collections import deque
 class BalanceBoardConnectionError(Exception):
     pass
 
+class RecordingFormatError(Exception):
+    pass
+
+# A recording is this magic string, then one little-endian int32 reading per
+# sensor for each sample, as the board reports them, in units of 10 g.
+RECORDING_MAGIC = b'weigh.py raw 1\n'
+SAMPLE = struct.Struct('<4i')
+
+def import_xwiimote():
+    # Only needed with a board, so recordings replay without the bindings
+    sys.path.append('/usr/local/lib64/python2.7/site-packages')
+    import xwiimote
+    return xwiimote
+
 @contextmanager
 def get_balance_board_iface():
+    xwiimote = import_xwiimote()
     mon = xwiimote.monitor(True, True)
     wiimote_path = mon.poll()
     while wiimote_path is not None:
@@ -45,7 +59,9 @@ def get_balance_board_iface():
     else:
         raise BalanceBoardConnectionError
 
-def weight_gen():
+def sensor_gen():
+    """Yield the four sensor readings of each balance board sample."""
+    xwiimote = import_xwiimote()
     with get_balance_board_iface() as bb:
         p = select.poll()
         p.register(bb.get_fd(), select.POLLIN)
@@ -53,20 +69,57 @@ def weight_gen():
         while True:
             p.poll()
             bb.dispatch(event)
-            decigrams = sum(x[0] for x in (event.get_abs(i) for i in range(4)))
-            yield decigrams / 100.0
+            yield tuple(event.get_abs(i)[0] for i in range(4))
+
+def record_gen(samples, filename):
+    """Pass samples through, writing them to a recording as they go by."""
+    with open(filename, 'wb') as recording:
+        recording.write(RECORDING_MAGIC)
+        for sample in samples:
+            recording.write(SAMPLE.pack(*sample))
+            yield sample
+
+def replay_gen(filename):
+    """Yield the samples of a recording made by record_gen."""
+    with open(filename, 'rb') as recording:
+        if recording.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise RecordingFormatError(
+                '{} is not a weigh.py recording'.format(filename))
+        while True:
+            data = recording.read(SAMPLE.size)
+            if len(data) < SAMPLE.size:
+                return
+            yield SAMPLE.unpack(data)
+
+def read_recording(filename):
+    """Read a whole recording as an (n, 4) NumPy array."""
+    import numpy as np
+    with open(filename, 'rb') as recording:
+        if recording.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise RecordingFormatError(
+                '{} is not a weigh.py recording'.format(filename))
+        data = np.frombuffer(recording.read(), dtype='<i4')
+    nsamples = len(data) // 4
+    return data[:nsamples * 4].reshape(nsamples, 4)
 
-def get_weight(navg=100):
+def weight_gen(samples):
+    """Yield the total of each sample's sensors, in units of 10 g."""
+    for sample in samples:
+        yield sum(sample)
+
+def get_weight(samples, navg=100):
     head_samples = deque([0] * navg)
     tail_samples = deque([0] * navg)
-    head_sum = 0.0
-    tail_sum = 0.0
+    head_sum = 0
+    tail_sum = 0
     seen = 0
-    for samp in weight_gen():
+    for samp in weight_gen(samples):
         # Two moving averages. The head average is of the last navg samples,
         # and the tail average is the navg samples before that.  By comparing
         # them, we can tell if the measurement has settled.  Verbose
-        # monstrosity to avoid traversing deque more than once.
+        # monstrosity to avoid traversing deque more than once.  The sums are
+        # kept in integer units of 10 g so they never drift, and the averages
+        # settle when they are within 0.1 kg, 10 units, of each other.
         head_samples.append(samp)
         head_sum += samp
         head_sum -= head_samples[0]
@@ -74,26 +127,85 @@ def get_weight(navg=100):
         tail_samples.append(head_samples.popleft())
         tail_sum -= tail_samples[0]
         tail_samples.popleft()
-        head_avg = head_sum / navg
-        tail_avg = tail_sum / navg
         seen += 1
-        if seen > navg * 2 and abs(head_avg - tail_avg) < 0.1:
-            return head_avg
+        if seen > navg * 2 and abs(head_sum - tail_sum) < 10 * navg:
+            return head_sum / (100.0 * navg)
+
+def find_settled(samples, navg=100):
+    """Find where get_weight would settle in a buffer of samples at once.
+
+    Parameters
+    ==========
+    samples : array_like
+        sensor readings, one row of four per sample
+    navg : int
+        samples in each moving average
+
+    Returns
+    =======
+    The number of samples get_weight reads before it settles, and the weight
+    it returns, or None if it doesn't settle within the buffer.
+    """
+    import numpy as np
+    totals = np.asarray(samples, dtype=np.int64).reshape(-1, 4).sum(axis=1)
+    if len(totals) <= 2 * navg:
+        return None
+    cumulative = np.zeros(len(totals) + 1, dtype=np.int64)
+    np.cumsum(totals, out=cumulative[1:])
+    # Cumulative sums at the ends of the tail and head windows, which
+    # get_weight compares after reading each sample from the 2 * navg + 1th
+    ends = cumulative[2 * navg + 1:]
+    middles = cumulative[navg + 1:len(cumulative) - navg]
+    starts = cumulative[1:len(cumulative) - 2 * navg]
+    settled = np.flatnonzero(np.abs(ends - 2 * middles + starts) < 10 * navg)
+    if len(settled) == 0:
+        return None
+    first = settled[0]
+    return (int(first) + 2 * navg + 1,
+            int(ends[first] - middles[first]) / (100.0 * navg))
 
-def log_weight_to_file(filename):
+def log_weight_to_file(filename, weight):
     if not os.path.exists(filename):
         with open(filename, 'w') as logfile:
             logfile.write('time weight_kg\n')
     with open(filename, 'a') as logfile:
-        logfile.write('{:.0f} {:.2f}\n'.format(time.time(), get_weight()))
+        logfile.write('{:.0f} {:.2f}\n'.format(time.time(), weight))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Measure weight with a Wii Balance Board and log to file.')
-    parser.add_argument('logfile', help='Where to log the weight.')
+    parser.add_argument('logfile', nargs='?',
+                        help='Where to log the weight.  If omitted, the '
+                        'weight is only printed.')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Also save the raw samples to this file.')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Measure the samples saved by --record instead '
+                        'of reading the balance board.')
+    parser.add_argument('--batch', action='store_true',
+                        help='Detect the settled weight of a --replay in one '
+                        'pass with NumPy, rather than sample by sample.')
+    parser.add_argument('--navg', type=int, default=100,
+                        help='Samples in each moving average (default 100).')
     args = parser.parse_args()
-    print('Please step onto the balace board.')
-    log_weight_to_file(args.logfile)
-
-
-
+    if args.batch and not args.replay:
+        parser.error('--batch only works with --replay')
+    if args.replay and args.batch:
+        settled = find_settled(read_recording(args.replay), args.navg)
+        weight = settled and settled[1]
+    else:
+        if args.replay:
+            samples = replay_gen(args.replay)
+        else:
+            print('Please step onto the balace board.')
+            samples = sensor_gen()
+        if args.record:
+            samples = record_gen(samples, args.record)
+        weight = get_weight(samples, args.navg)
+        # Finish the recording and release the board before going on
+        samples.close()
+    if weight is None:
+        sys.exit('The weight never settled.')
+    print('{:.2f} kg'.format(weight))
+    if args.logfile:
+        log_weight_to_file(args.logfile, weight)